@@ -0,0 +1,75 @@
+# Copyright 2019, Oath Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+from ariel import get_ec2_pricing, utils, LOGGER
+
+import ariel
+import botocore.exceptions
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import pickle
+
+
+def fingerprint(value):
+    # Content hash of frames, pricing tables and JSON serializable values
+    digest = hashlib.sha256()
+    if isinstance(value, pd.DataFrame):
+        digest.update(json.dumps([[str(column) for column in value.columns],
+                                  [str(dtype) for dtype in value.dtypes]]).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(value, index=True).values)
+    elif isinstance(value, get_ec2_pricing.PricingTable):
+        digest.update(json.dumps([value.codes, value.reserved, value.units], sort_keys=True).encode('utf-8'))
+        digest.update(np.ascontiguousarray(value.data).view(np.uint8))
+    else:
+        digest.update(json.dumps(value, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ArtifactStore(object):
+    """Outputs of report stages under a file:// or s3:// prefix, named by a hash of the stage and its inputs."""
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix if prefix == '' or prefix.endswith('/') else prefix + '/'
+
+    def key(self, stage, *inputs):
+        # Outputs of another version of Ariel are never reused
+        return fingerprint([ariel.__version__, stage] + [fingerprint(value) for value in inputs])
+
+    def get_filename(self, stage, key):
+        return '{}{}/{}.pkl'.format(self.prefix, stage, key)
+
+    def load(self, stage, key):
+        try:
+            with utils.get_read_handle(self.get_filename(stage, key), 'rb') as input:
+                return pickle.load(input)
+        except FileNotFoundError:
+            return None
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+
+    def save(self, stage, key, value):
+        filename = self.get_filename(stage, key)
+        if filename.startswith('file://'):
+            os.makedirs(os.path.dirname(filename[7:]), exist_ok=True)
+        with utils.get_temp_write_handle(filename, 'wb') as output:
+            pickle.dump(value, output, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def run(self, stage, inputs, compute):
+        """Key of the stage and its output, loaded if the store has it for these inputs, otherwise computed and saved.
+
+        Inputs are frames, pricing tables, configuration values, or the keys of earlier stages.
+        """
+        if self.prefix == '':
+            return None, compute()
+        key = self.key(stage, *inputs)
+        value = self.load(stage, key)
+        if value is None:
+            value = compute()
+            self.save(stage, key, value)
+        else:
+            LOGGER.info("Reusing {} from {}".format(stage, self.get_filename(stage, key)))
+        return key, value
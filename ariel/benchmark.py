@@ -0,0 +1,225 @@
+# Copyright 2019, Oath Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+from ariel import generate_reports, get_account_instance_summary, get_ec2_pricing, get_reserved_instances, profiling, utils, LOGGER
+
+import copy
+import multiprocessing
+import numpy as np
+import pandas as pd
+import sys
+import time
+
+REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1']
+FAMILIES = ['c5', 'm5', 'r5', 't3']
+SIZES = {'large': 4.0, 'xlarge': 8.0, '2xlarge': 16.0, '4xlarge': 32.0}
+OPERATING_SYSTEMS = ['Linux', 'RHEL', 'Windows']
+ZONES = 'abc'
+ACCOUNT_BASE = 100000000000
+
+# (accounts, days) evaluated by default
+SCALES = [(10, 14), (100, 28), (1000, 60), (5000, 90)]
+
+STAGES = ['enrich', 'usage', 'trends', 'allocate', 'purchases', 'reports']
+
+CONFIG = {
+    'RI_PURCHASES': {
+        'RI_TERM': 36,
+        'RI_OPTION': 'No Upfront',
+        'RI_SIZE': 'xlarge',
+        'FILTER_THRESHOLD': 3,
+        'AGGRESSIVE_THRESHOLD': 0.5,
+        'CONSERVATIVE_THRESHOLD': -0.5,
+        'SLUSH_ACCOUNT': ACCOUNT_BASE - 1,
+        'STANDARD_AGGRESSIVE_UTIL_TARGET': 'BREAK_EVEN',
+        'STANDARD_DEFAULT_UTIL_TARGET': 80,
+        'STANDARD_CONSERVATIVE_UTIL_TARGET': 90,
+        'CONVERTIBLE_AGGRESSIVE_SLUSH_UTIL_TARGET': 'BREAK_EVEN',
+        'CONVERTIBLE_DEFAULT_SLUSH_UTIL_TARGET': 80,
+        'CONVERTIBLE_CONSERVATIVE_SLUSH_UTIL_TARGET': 100,
+    },
+}
+
+
+def get_instance_types(families):
+    return ['{}.{}'.format(family, size) for family in families for size in SIZES]
+
+
+def make_pricing(regions=REGIONS, families=FAMILIES):
+    """Pricing table for every instance type of families in regions, plus us-east-1 for reference sizes."""
+    prices = {'units': {}}
+    for region in sorted(set(regions) | {'us-east-1'}):
+        prices[region] = {}
+        for family_index, family in enumerate(families):
+            for size, units in SIZES.items():
+                instancetype = '{}.{}'.format(family, size)
+                prices['units'][instancetype] = units
+                prices[region][instancetype] = {'Shared': {}}
+                for os_index, operatingsystem in enumerate(OPERATING_SYSTEMS):
+                    od_rate = 0.0125 * units * (1 + 0.1 * family_index) * (1 + 0.5 * os_index)
+                    reserved = {}
+                    for term, months in (('1yr', 12), ('3yr', 36)):
+                        for offering, discount in (('standard', 0.6), ('convertible', 0.7)):
+                            for option, upfront in (('No Upfront', 0.0), ('Partial Upfront', 0.5), ('All Upfront', 1.0)):
+                                reserved['{}-{}-{}'.format(term, offering, option)] = {
+                                    'upfront': od_rate * discount * 730 * months * upfront,
+                                    'hourly': od_rate * discount * (1 - upfront),
+                                }
+                    prices[region][instancetype]['Shared'][operatingsystem] = {
+                        'sku': '{}.{}.{}'.format(region, instancetype, operatingsystem),
+                        'onDemandRate': od_rate,
+                        'reserved': reserved,
+                    }
+    return get_ec2_pricing.PricingTable.from_dict(prices)
+
+
+def make_instances(accounts, days, regions=REGIONS, families=FAMILIES, workloads=3, seed=0, end='2020-03-01'):
+    """Hourly account instance summary for workloads per account, typed like get_account_instance_summary."""
+    rng = np.random.default_rng(seed)
+    # Both ends are included, so that the window spans the full number of days
+    hours = pd.date_range(pd.Timestamp(end) - pd.Timedelta(days=days), pd.Timestamp(end), freq='H')
+    zones = ['{}{}'.format(region, zone) for region in regions for zone in ZONES]
+    instancetypes = get_instance_types(families)
+
+    # Distinct (zone, type, os) combinations per account, so rows are unique like the CUR summary
+    combinations = len(zones) * len(instancetypes) * len(OPERATING_SYSTEMS)
+    workloads = min(workloads, combinations)
+    chosen = rng.random((accounts, combinations)).argsort(axis=1)[:, :workloads].ravel()
+    zone_codes, rest = np.divmod(chosen, len(instancetypes) * len(OPERATING_SYSTEMS))
+    type_codes, os_codes = np.divmod(rest, len(OPERATING_SYSTEMS))
+    account_ids = np.repeat(ACCOUNT_BASE + np.arange(accounts, dtype=np.int64) * 7, workloads)
+
+    # Some workloads start late or stop early
+    count = len(chosen)
+    start = np.where(rng.random(count) < 0.2, rng.integers(0, len(hours) // 2 + 1, count), 0)
+    stop = np.where(rng.random(count) < 0.2, rng.integers(len(hours) // 2 + 1, len(hours) + 1, count), len(hours))
+    lengths = stop - start
+    workload = np.repeat(np.arange(count), lengths)
+    hour = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(start, lengths)
+
+    # Daily cycle around a trending base, with noise
+    base = rng.integers(1, 20, count).astype(float)
+    trend = rng.normal(0, 0.002, count)
+    cycle = 2 * np.sin(hours.hour.values / 24.0 * 2 * np.pi)
+    instances = np.maximum(1.0, np.round(base[workload] + trend[workload] * hour + cycle[hour] +
+                                         rng.normal(0, 1, len(hour))))
+    reserved = np.minimum(instances, rng.integers(0, 3, len(hour)))
+
+    return pd.DataFrame({
+        'usagestartdate': hours.values[hour],
+        'usageaccountid': account_ids[workload],
+        'availabilityzone': pd.Categorical.from_codes(zone_codes[workload], zones),
+        'instancetype': pd.Categorical.from_codes(type_codes[workload], instancetypes),
+        'tenancy': pd.Categorical.from_codes(np.zeros(len(hour), dtype=int), ['Shared']),
+        'operatingsystem': pd.Categorical.from_codes(os_codes[workload], OPERATING_SYSTEMS),
+        'instances': instances.astype(get_account_instance_summary.COLUMNS['instances']),
+        'reserved': reserved.astype(get_account_instance_summary.COLUMNS['reserved']),
+    })
+
+
+def make_ris(instances, ri_density=0.5, seed=0):
+    """Active RIs for about ri_density of the workloads in instances, typed like get_reserved_instances."""
+    rng = np.random.default_rng(seed + 1)
+    keys = ['usageaccountid', 'availabilityzone', 'instancetype', 'operatingsystem']
+    workloads = instances.groupby(keys, observed=True)['instances'].median().reset_index()
+    workloads = workloads[rng.random(len(workloads)) < ri_density].reset_index(drop=True)
+
+    regional = rng.random(len(workloads)) < 0.6
+    availabilityzone = workloads['availabilityzone'].astype(str)
+    units = np.array([SIZES[instancetype.split('.')[1]] for instancetype in workloads['instancetype'].astype(str)])
+    quantity = np.maximum(1, np.round(workloads['instances'].values * rng.uniform(0.3, 1.1, len(workloads))))
+    ris = pd.DataFrame({
+        'accountid': workloads['usageaccountid'].values,
+        'accountname': ['account-{}'.format(account) for account in workloads['usageaccountid']],
+        'reservationid': ['ri-{:08d}'.format(row) for row in range(len(workloads))],
+        'subscriptionid': ['{:010d}'.format(row) for row in range(len(workloads))],
+        'startdate': '2019-01-01T00:00:00.000Z',
+        'enddate': '2022-01-01T00:00:00.000Z',
+        'state': 'active',
+        'quantity': quantity.astype(int),
+        'availabilityzone': np.where(regional, '', availabilityzone),
+        'region': availabilityzone.str[:-1].values,
+        'instancetype': workloads['instancetype'].astype(str).values,
+        'paymentoption': 'No Upfront',
+        'tenancy': 'Shared',
+        'operatingsystem': workloads['operatingsystem'].astype(str).values,
+        'amortizedhours': 720,
+        'amortizedupfrontprice': 0.0,
+        'amortizedrecurringfee': np.round(quantity * units * 0.0125 * 0.6 * 720, 2),
+        'offeringclass': np.where(rng.random(len(workloads)) < 0.7, 'standard', 'convertible'),
+        'scope': np.where(regional, 'Region', 'Availability Zone'),
+    })
+    return utils.apply_columns(ris, get_reserved_instances.COLUMNS)
+
+
+def run(config, accounts, days, regions=REGIONS, families=FAMILIES, workloads=3, ri_density=0.5, seed=0):
+    """Generates inputs at one scale and times the stages of generate_reports.generate on them."""
+    pricing = make_pricing(regions, families)
+    instances = make_instances(accounts, days, regions, families, workloads, seed)
+    ris = make_ris(instances, ri_density, seed)
+    input_rss = profiling.get_peak_rss()
+
+    profiler = profiling.PROFILER
+    profiler.reset()
+    start, cpu = time.perf_counter(), profiling.get_cpu_time()
+    reports = generate_reports.generate(copy.deepcopy(config), instances, ris, pricing)
+    seconds = time.perf_counter() - start
+
+    result = {
+        'accounts': accounts,
+        'days': days,
+        'instance_rows': len(instances),
+        'ri_rows': len(ris),
+        'groups': len(reports['RI_TRENDS']),
+        'purchases': len(reports['RI_PURCHASES']),
+    }
+    stages = dict((stage.name, stage.wall_seconds) for stage in profiler.stages)
+    for stage in STAGES:
+        result['{}_seconds'.format(stage)] = stages.get(stage, np.nan)
+    result['generate_seconds'] = seconds
+    result['cpu_seconds'] = profiling.get_cpu_time() - cpu
+    result['rows_per_second'] = len(instances) / seconds
+    result['input_rss_mb'] = input_rss
+    result['peak_rss_mb'] = profiling.get_peak_rss()
+    return result
+
+
+def benchmark(config, scales=SCALES, **kwargs):
+    """Runs each (accounts, days) scale in a fresh process, so that peak memory is measured per scale."""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for accounts, days in scales:
+        LOGGER.info("Benchmarking {} accounts over {} days...".format(accounts, days))
+        with context.Pool(1) as pool:
+            result = pool.apply(run, (config, accounts, days), kwargs)
+        LOGGER.info("{} rows in {:.2f}s ({:,.0f} rows/s), peak RSS {:.0f} MB".format(result['instance_rows'],
+                    result['generate_seconds'], result['rows_per_second'], result['peak_rss_mb']))
+        results.append(result)
+    return pd.DataFrame(results)
+
+
+def parse_scales(value):
+    # "10x14,100x28" as [(10, 14), (100, 28)]
+    return [tuple(int(part) for part in scale.split('x')) for scale in value.split(',')]
+
+
+def cli():
+    import argparse
+    parser = argparse.ArgumentParser(prog='{} {}'.format(*(sys.argv[0], sys.argv[1])))
+    parser.add_argument('--config', help='Config file with RI_PURCHASES settings.  Default: built in benchmark settings')
+    parser.add_argument('--scales', type=parse_scales, default=SCALES,
+                        help='Comma separated ACCOUNTSxDAYS scales.  Default: 10x14,100x28,1000x60,5000x90')
+    parser.add_argument('--regions', default=','.join(REGIONS), help='Comma separated regions')
+    parser.add_argument('--families', default=','.join(FAMILIES), help='Comma separated instance families')
+    parser.add_argument('--workloads', type=int, default=3, help='Instance workloads per account')
+    parser.add_argument('--ri-density', type=float, default=0.5, help='Fraction of workloads covered by RIs')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--output', help='CSV file to write results to.  Default: stdout')
+
+    args = parser.parse_args(args=sys.argv[2:])
+    config = utils.load_config(args.config) if args.config is not None else CONFIG
+    results = benchmark(config, args.scales, regions=args.regions.split(','), families=args.families.split(','),
+                        workloads=args.workloads, ri_density=args.ri_density, seed=args.seed)
+    results.to_csv(args.output if args.output is not None else sys.stdout, index=False)
+
+if __name__ == '__main__':
+    cli()
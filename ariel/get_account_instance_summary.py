@@ -2,101 +2,191 @@
 # Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
 from ariel import utils, LOGGER
 
-import boto3
 import datetime
 import os
 import pandas as pd
 import sys
-import time
 
-def load(config):
+CACHE_FILE = '/tmp/cached-account-instance-summary.csv'
+COLUMNS = {
+    'usagestartdate': 'datetime',
+    'usageaccountid': 'int64',
+    'availabilityzone': 'category',
+    'instancetype': 'category',
+    'tenancy': 'category',
+    'operatingsystem': 'category',
+    'instances': 'float32',
+    'reserved': 'float32',
+}
+ENRICHED_COLUMNS = {
+    'usagestartdate': 'datetime',
+    'hourofweek': 'int16',
+    'usageaccountid': 'int64',
+    'region': 'category',
+    'availabilityzone': 'category',
+    'instancetypefamily': 'category',
+    'instancetype': 'category',
+    'tenancy': 'category',
+    'operatingsystem': 'category',
+    'instances': 'float32',
+    'reserved': 'float32',
+    'instance_units': 'float64',
+    'reserved_units': 'float64',
+}
+
+def is_enriched(config, pricing):
+    # Enrichment needs normalization factors, so queries submitted before pricing is loaded are not enriched
+    return utils.get_config_value(config, 'ATHENA', 'ENRICH', False) and pricing is not None
+
+def get_columns(config, pricing=None):
+    return ENRICHED_COLUMNS if is_enriched(config, pricing) else COLUMNS
+
+def get_store(config, pricing=None):
+    # Day partitioned copy of the summary, so only new or restated days need to be queried
+    store = utils.get_config_value(config, 'ATHENA', 'SUMMARY_STORE', '')
+    if store == '':
+        return ''
+    database = utils.get_config_value(config, 'ATHENA', 'CUR_DATABASE')
+    table_name = utils.get_config_value(config, 'ATHENA', 'CUR_TABLE_NAME', 'cur')
+    suffix = '.enriched' if is_enriched(config, pricing) else ''
+    return '{}/{}.{}{}/'.format(store.rstrip('/'), database, table_name, suffix)
+
+def get_partition(store, day):
+    return '{}usagestartdate={}.csv'.format(store, day.strftime('%Y-%m-%d'))
+
+def get_missing_days(config, pricing=None):
+    # Days of the window without a stored partition, plus the most recent days which may still be restated
+    store = get_store(config, pricing)
+    restatement_days = int(utils.get_config_value(config, 'ATHENA', 'RESTATEMENT_DAYS', 3))
+    starttime, endtime = utils.get_time_range(config)
+    stored = set(utils.list_uri(store))
+    days = [starttime + datetime.timedelta(days=i) for i in range((endtime - starttime).days)]
+    return [day for day in days if day >= endtime - datetime.timedelta(days=restatement_days) or
+            get_partition(store, day)[len(store):] not in stored]
+
+def query(config, pricing=None):
+    database = utils.get_config_value(config, 'ATHENA', 'CUR_DATABASE')
+    table_name = utils.get_config_value(config, 'ATHENA', 'CUR_TABLE_NAME', 'cur')
+    starttime, endtime = utils.get_time_range(config)
+
+    # With a summary store, query from the first missing day on
+    if get_store(config, pricing) != '':
+        missing = get_missing_days(config, pricing)
+        if len(missing) == 0:
+            return None
+        starttime = missing[0]
+
+    # Download Instance and RI usage
+    query = ' '.join((""
+        + "  WITH preprocess AS ( "
+        + "       SELECT line_item_usage_start_date AS usagestartdate, "
+        + "              line_item_usage_account_id AS usageaccountid, "
+        + "              line_item_availability_zone AS availabilityzone, "
+        + "              CASE WHEN line_item_usage_type LIKE '%:%' THEN SPLIT(line_item_usage_type, ':')[2] "
+        + "                   WHEN line_item_line_item_description LIKE '%m1.small%' THEN 'm1.small' "
+        + "                   WHEN line_item_line_item_description LIKE '%m1.medium%' THEN 'm1.medium' "
+        + "                   WHEN line_item_line_item_description LIKE '%m1.large%' THEN 'm1.large' "
+        + "                   WHEN line_item_line_item_description LIKE '%m1.xlarge%' THEN 'm1.xlarge' "
+        + "                   ELSE 'm1.error' "
+        + "              END AS instancetype, "
+        + "              product_tenancy AS tenancy, "
+        + "              product_operating_system AS operatingsystem, "
+        + "              CAST(line_item_usage_amount AS double) as usageamount, "
+        + "              CASE WHEN line_item_line_item_type = 'DiscountedUsage' THEN CAST(line_item_usage_amount AS DOUBLE) ELSE 0 END as reservedamount "
+        + "         FROM " + database + "." + table_name
+        + "        WHERE product_operation = 'RunInstances' "
+        + "          AND line_item_availability_zone != '' "
+        + "          AND line_item_availability_zone NOT LIKE '%-wlz-%' " # Filter out Wavelength Instances.  They're not available for RIs.
+        + "          AND product_tenancy = 'Shared' "
+        + "          " + utils.get_partition_filter(config, starttime, endtime)
+        + " ) "
+        + "SELECT usagestartdate, usageaccountid, availabilityzone, instancetype, tenancy, operatingsystem, SUM(usageamount) as instances, SUM(reservedamount) as reserved "
+        + "  FROM preprocess "
+        + " WHERE usagestartdate >= cast('{}' as timestamp) ".format(starttime.isoformat(' '))
+        + "   AND usagestartdate < cast('{}' as timestamp) ".format(endtime.isoformat(' '))
+        + " GROUP BY usagestartdate, usageaccountid, availabilityzone, instancetype, tenancy, operatingsystem "
+        + " ORDER BY usagestartdate, usageaccountid, availabilityzone, instancetype, tenancy, operatingsystem "
+        ).split())
+    if is_enriched(config, pricing):
+        query = enrich(query, pricing)
+    return query
+
+def enrich(query, pricing):
+    # Add the columns generate_reports would otherwise derive, dropping instance types without normalization factors
+    units = ', '.join("('{}', DOUBLE '{!r}')".format(instancetype.replace("'", "''"), float(units))
+                      for instancetype, units in sorted(pricing.units.items()))
+    query = ' '.join((""
+        + "  WITH summary AS ( " + query + " ) "
+        + "SELECT summary.usagestartdate, "
+        + "       (day_of_week(summary.usagestartdate) - 1) * 24 + hour(summary.usagestartdate) AS hourofweek, "
+        + "       summary.usageaccountid, "
+        + "       substr(summary.availabilityzone, 1, length(summary.availabilityzone) - 1) AS region, "
+        + "       summary.availabilityzone, "
+        + "       split_part(summary.instancetype, '.', 1) AS instancetypefamily, "
+        + "       summary.instancetype, summary.tenancy, summary.operatingsystem, summary.instances, summary.reserved, "
+        + "       summary.instances * units.units AS instance_units, "
+        + "       summary.reserved * units.units AS reserved_units "
+        + "  FROM summary "
+        + "  JOIN (VALUES " + units + ") AS units (instancetype, units) "
+        + "    ON summary.instancetype = units.instancetype "
+        + " ORDER BY usagestartdate, usageaccountid, availabilityzone, instancetype, tenancy, operatingsystem "
+        ).split())
+    return query
+
+def load(config, athena=None, pricing=None):
 
     # If local files exists and is less than a day old, just use it.
-    cache_file = '/tmp/cached-account-instance-summary.csv'
+    cache_file = CACHE_FILE
     caching = utils.get_config_value(config, 'DEFAULTS', 'CACHING', False)
-    mtime = 0
-    if caching:
-        try:
-            mtime = os.stat(cache_file).st_mtime
-        except FileNotFoundError:
-            mtime = 0
-
-    if mtime > time.time() - 86400:
+    columns = get_columns(config, pricing)
+    if utils.is_cache_fresh(config, cache_file):
         LOGGER.info("Using existing cache file: " + cache_file)
+        result = utils.read_csv(cache_file, columns)
+    elif get_store(config, pricing) != '':
+        result = load_store(config, athena, pricing)
+        if caching:
+            result.to_csv(cache_file, index=False)
     else:
-        account, role = utils.get_master(config)
-        region   = utils.get_config_value(config, 'ATHENA', 'AWS_REGION',
-                   utils.get_config_value(config, 'DEFAULTS', 'AWS_REGION',
-                                          os.environ.get('AWS_DEFAULT_REGION')))
-        database = utils.get_config_value(config, 'ATHENA', 'CUR_DATABASE')
-        table_name = utils.get_config_value(config, 'ATHENA', 'CUR_TABLE_NAME', 'cur')
-        staging  = utils.get_config_value(config, 'ATHENA', 'STAGING',
-                                          's3://aws-athena-query-results-{0}-{1}/ariel-cur-output/'.format(account, region))
-        days     = utils.get_config_value(config, 'ATHENA', 'DAYS', 28)
-        offset   = utils.get_config_value(config, 'ATHENA', 'OFFSET', 1)
-
-        session = boto3.Session()
-        proto, empty, staging_bucket, staging_prefix = staging.split('/', 3)
-
-        # Assume role if needed
-        if role is not None:
-            session = utils.assume_role(session, role)
-
-        # Connect to Athena
-        athena = session.client('athena', region_name=region)
-
-        # Validate database is usable
-        status_id = utils.execute_athena_query(athena, staging, 'SELECT status FROM ' + database + '.cost_and_usage_data_status')
-
-        # Row 0 is header
-        status = athena.get_query_results(QueryExecutionId=status_id)['ResultSet']['Rows'][1]['Data'][0]['VarCharValue']
-        if status != 'READY':
-            raise Exception('Athena database not in READY status')
-
-        # Identify start to end range query
-        today = datetime.datetime.combine(datetime.datetime.today(), datetime.time.min)
-        endtime = today - datetime.timedelta(days=offset)
-        starttime = endtime - datetime.timedelta(days=days)
-
-        # Download Instance and RI usage
-        query = ' '.join((""
-            + "  WITH preprocess AS ( "
-            + "       SELECT line_item_usage_start_date AS usagestartdate, "
-            + "              line_item_usage_account_id AS usageaccountid, "
-            + "              line_item_availability_zone AS availabilityzone, "
-            + "              CASE WHEN line_item_usage_type LIKE '%:%' THEN SPLIT(line_item_usage_type, ':')[2] "
-            + "                   WHEN line_item_line_item_description LIKE '%m1.small%' THEN 'm1.small' "
-            + "                   WHEN line_item_line_item_description LIKE '%m1.medium%' THEN 'm1.medium' "
-            + "                   WHEN line_item_line_item_description LIKE '%m1.large%' THEN 'm1.large' "
-            + "                   WHEN line_item_line_item_description LIKE '%m1.xlarge%' THEN 'm1.xlarge' "
-            + "                   ELSE 'm1.error' "
-            + "              END AS instancetype, "
-            + "              product_tenancy AS tenancy, "
-            + "              product_operating_system AS operatingsystem, "
-            + "              CAST(line_item_usage_amount AS double) as usageamount, "
-            + "              CASE WHEN line_item_line_item_type = 'DiscountedUsage' THEN CAST(line_item_usage_amount AS DOUBLE) ELSE 0 END as reservedamount "
-            + "         FROM " + database + "." + table_name
-            + "        WHERE product_operation = 'RunInstances' "
-            + "          AND line_item_availability_zone != '' "
-            + "          AND line_item_availability_zone NOT LIKE '%-wlz-%' " # Filter out Wavelength Instances.  They're not available for RIs.
-            + "          AND product_tenancy = 'Shared' "
-            + " ) "
-            + "SELECT usagestartdate, usageaccountid, availabilityzone, instancetype, tenancy, operatingsystem, SUM(usageamount) as instances, SUM(reservedamount) as reserved "
-            + "  FROM preprocess "
-            + " WHERE usagestartdate >= cast('{}' as timestamp) ".format(starttime.isoformat(' '))
-            + "   AND usagestartdate < cast('{}' as timestamp) ".format(endtime.isoformat(' '))
-            + " GROUP BY usagestartdate, usageaccountid, availabilityzone, instancetype, tenancy, operatingsystem "
-            + " ORDER BY usagestartdate, usageaccountid, availabilityzone, instancetype, tenancy, operatingsystem "
-            ).split())
-        query_id = utils.execute_athena_query(athena, staging, query)
-        session.client('s3').download_file(staging_bucket, '{0}{1}.csv'.format(staging_prefix, query_id), cache_file)
-
-    result = pd.read_csv(cache_file, parse_dates=['usagestartdate'])
-
-    LOGGER.info("Loaded {} instance summary rows".format(len(result)))
+        if athena is None:
+            athena = utils.AthenaExecutor(config)
+        athena.validate()
+        query_id = athena.execute(query(config, pricing))
+        result = athena.read(query_id, columns, cache_file if caching else None)
+
+    LOGGER.info("Loaded {} instance summary rows ({:.1f} MB)".format(len(result), utils.memory_usage(result)))
     return result
 
 
+def load_store(config, athena=None, pricing=None):
+    store = get_store(config, pricing)
+    columns = get_columns(config, pricing)
+    starttime, endtime = utils.get_time_range(config)
+
+    # Query Athena from the first missing day on, and store the result by day
+    missing = get_missing_days(config, pricing)
+    if len(missing) > 0:
+        LOGGER.info("Querying {} days of instance summary from {}".format((endtime - missing[0]).days, missing[0]))
+        if athena is None:
+            athena = utils.AthenaExecutor(config)
+        athena.validate()
+        query_id = athena.execute(query(config, pricing))
+        queried = athena.read(query_id, columns)
+        queried_days = queried['usagestartdate'].dt.floor('D')
+        if store.startswith('file://'):
+            os.makedirs(store[7:], exist_ok=True)
+        for i in range((endtime - missing[0]).days):
+            day = missing[0] + datetime.timedelta(days=i)
+            with utils.get_temp_write_handle(get_partition(store, day)) as output:
+                queried[queried_days == day].to_csv(output, index=False)
+
+    # Assemble the window from the stored days
+    partitions = []
+    for i in range((endtime - starttime).days):
+        with utils.get_read_handle(get_partition(store, starttime + datetime.timedelta(days=i))) as input:
+            partitions.append(utils.read_csv(input, columns))
+    return utils.apply_columns(pd.concat(partitions, ignore_index=True), columns)
+
+
 def cli():
     import argparse, yaml
     parser = argparse.ArgumentParser(prog='{} {}'.format(*(sys.argv[0], sys.argv[1])))
@@ -3,7 +3,6 @@
 from ariel import utils, LOGGER
 from time import sleep
 
-import boto3
 import os
 import sys
 import time
@@ -31,8 +30,7 @@ def load(config):
         account_names = {}
         if role != '':
             # Organizations should be queried, load that first
-            session = utils.assume_role(boto3.Session(), role)
-            org = session.client('organizations', region_name='us-east-1')
+            org = utils.SESSIONS.client('organizations', 'us-east-1', role)
 
             rsp = org.list_accounts()
             while True:
@@ -1,19 +1,29 @@
 # Copyright 2019, Oath Inc.
 # Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
 from ariel import utils, LOGGER
+from concurrent.futures import ThreadPoolExecutor
 
-import codecs
 import csv
+import hashlib
+import io
 import json
+import math
+import numpy as np
 import os
+import pandas as pd
+import struct
 import sys
 import time
+import types
 import yaml
 
 try:
-    from urllib.request import urlopen  # Python 3
+    from urllib.error import HTTPError  # Python 3
+    from urllib.request import Request, urlopen
+    from urllib.parse import urljoin
 except:
-    from urllib2 import urlopen  # Python 2
+    from urllib2 import HTTPError, Request, urlopen  # Python 2
+    from urlparse import urljoin
 
 LOCATIONS = {
     "Asia Pacific (Hong Kong)": "ap-east-1",
@@ -41,159 +51,525 @@ LOCATIONS = {
     "US West (Oregon)": "us-west-2"
 }
 
+# Columns of the offer file used by Ariel
+NORMALIZATION_COLUMN = 'Normalization Size Factor'
+OFFER_COLUMNS = [
+    'SKU', 'TermType', 'Unit', 'PricePerUnit', 'LeaseContractLength', 'OfferingClass', 'PurchaseOption',
+    'Product Family', 'serviceCode', 'Location', 'Location Type', 'Instance Type', 'Tenancy', 'Operating System',
+    'License Model', 'Pre Installed S/W', 'instanceSKU', 'operation', NORMALIZATION_COLUMN
+]
+
+def resolve_locations(config, locations=LOCATIONS):
+    # Region of each pricing location, including those configured in the LOCATIONS section.  '' skips a location.
+    resolved = dict(locations)
+    for location, region in (config.get('LOCATIONS') or {}).items():
+        resolved.setdefault(location, region or '')
+    return resolved
+
 def load(config, locations=LOCATIONS):
+    locations = resolve_locations(config, locations)
 
-    # If local files exists and is less than a day old, just use it.
-    cache_file = '/tmp/cached-ec2-pricing.json'
+    # If a local cache exists and the offer has not been republished since, just use it.
+    cache_format = utils.get_config_value(config, 'PRICING', 'CACHE_FORMAT', 'binary')
+    cache_file = '/tmp/cached-ec2-pricing.json' if cache_format == 'json' else '/tmp/cached-ec2-pricing.bin'
+    version_file = cache_file + '.version'
     caching = utils.get_config_value(config, 'DEFAULTS', 'CACHING', False)
+    regional = utils.get_config_value(config, 'PRICING', 'REGIONAL', False)
     mtime = 0
+    cached_version = None
     if caching:
         try:
             mtime = os.stat(cache_file).st_mtime
+            with open(version_file) as input:
+                cached_version = json.load(input)
         except FileNotFoundError:
             pass
 
-    if mtime > time.time() - 86400:
+    # Caches built with another location map are rebuilt, whether or not the offer changed
+    locations_hash = hashlib.sha256(json.dumps(locations, sort_keys=True).encode('utf-8')).hexdigest()
+    if cached_version is not None and cached_version.pop('locations', None) != locations_hash:
+        LOGGER.info("Pricing locations changed, rebuilding cache file: " + cache_file)
+        cached_version, mtime = None, 0
+
+    # Caches without a recorded offer version fall back to expiring after a day
+    if cached_version is None and mtime > time.time() - 86400:
         LOGGER.info("Using existing cache file: " + cache_file)
     else:
-        pricing_url  = utils.get_config_value(config, 'PRICING', 'URL', 'https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/index.csv')
+        if regional:
+            version, offer = open_regions(config, locations, cached_version)
+        else:
+            pricing_url  = utils.get_config_value(config, 'PRICING', 'URL', 'https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/index.csv')
+            version, offer = open_offer(pricing_url, cached_version)
 
-        csv_reader = csv.reader(codecs.iterdecode(urlopen(pricing_url), 'utf-8'), utils.CsvDialect())
+        if offer is None:
+            LOGGER.info("Pricing offer unchanged, using existing cache file: " + cache_file)
+            os.utime(cache_file)
+        else:
+            if regional:
+                prices = load_regions(config, offer, locations)
+            else:
+                with offer:
+                    prices = parse_offer(offer, config, locations)
 
-        # Find header row
-        header_map = None
-        while header_map is None:
-            header = next(csv_reader)
-            if header[0] == "SKU":
-                header_map = utils.parse_header(header)
+            pricing = PricingTable.from_dict(prices)
+            if cache_format == 'json':
+                with open(cache_file, 'w') as outfile:
+                    json.dump(prices, outfile, indent=4)
+            else:
+                save_cache(pricing, cache_file)
+            with open(version_file, 'w') as outfile:
+                json.dump(dict(version, locations=locations_hash), outfile)
+            return pricing
 
-        rowcount = 0
-        prices = {}
-        units = {}
-        for row in csv_reader:
-            if not check_row(header_map, row):
-                continue
+    if cache_format == 'json':
+        with utils.get_read_handle(cache_file) as input:
+            return PricingTable.from_dict(json.load(input))
+    return load_cache(cache_file)
 
-            sku = row[header_map['SKU']]
-            location = row[header_map['Location']]
-            instanceType = row[header_map['Instance Type']]
-            tenancy = row[header_map['Tenancy']]
-            operatingsystem = row[header_map['Operating System']]
-
-            # Resolve the AWS Region from location information.
-            if location not in locations:
-                locations[location] = utils.get_config_value(config, 'LOCATIONS', location, '')
-                if locations[location] == '':
-                    LOGGER.info('Skipping unknown location: {}'.format(location))
-            if locations[location] == '':
-                continue
-            region = locations[location]
-
-            # Populate result set
-            if region not in prices:
-                prices[region] = {}
-            if instanceType not in prices[region]:
-                prices[region][instanceType] = {}
-            if tenancy not in prices[region][instanceType]:
-                prices[region][instanceType][tenancy] = {}
-            if operatingsystem not in prices[region][instanceType][tenancy]:
-                prices[region][instanceType][tenancy][operatingsystem] = {
-                    "sku": sku,
-                    "reserved": {}
-                }
-                try:
-                    units[instanceType] = float(row[header_map['Normalization Size Factor']])
-                except ValueError as e:
-                    LOGGER.warning('Invalid pricing data: {}:{} -> {}'.format(region, instanceType, sku))
-                    continue
-
-            price = prices[region][instanceType][tenancy][operatingsystem]
-            if price['sku'] != sku:
-                print('WARNING: Duplicate sku: {}:{} -> {} != {}'.format(region, instanceType, sku, price['sku']))
-                continue
+def open_offer(url, cached_version=None):
+    # Returns the offer version, and a response to parse or None if the cached version is still current
+    request = Request(url)
+    if cached_version is not None and cached_version.get('url') == url:
+        if cached_version.get('etag'):
+            request.add_header('If-None-Match', cached_version['etag'])
+        if cached_version.get('last_modified'):
+            request.add_header('If-Modified-Since', cached_version['last_modified'])
+
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if e.code == 304:
+            return cached_version, None
+        raise
+
+    version = {
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+
+    # Not every server (or file://) honors conditional requests, so compare the validators ourselves too
+    if version == cached_version and (version['etag'] or version['last_modified']):
+        response.close()
+        return cached_version, None
+    return version, response
+
+def open_regions(config, locations=LOCATIONS, cached_version=None):
+    # Returns the offer version, and the offer url by region or None if the cached version is still current
+    index_url = utils.get_config_value(config, 'PRICING', 'REGION_INDEX_URL', 'https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/region_index.json')
+
+    # Only fetch offers for the regions we know about
+    with urlopen(index_url) as input:
+        offers = json.loads(input.read().decode('utf-8'))['regions']
+    regions = sorted(set(region for region in locations.values() if region != ''))
+    urls = {}
+    for region in regions:
+        if region not in offers:
+            LOGGER.warning('No pricing offer for region: {}'.format(region))
+            continue
+        # Offer URLs are relative to the index, and reference the json version of the offer
+        url = urljoin(index_url, offers[region]['currentVersionUrl'])
+        urls[region] = url[:-len('.json')] + '.csv' if url.endswith('.json') else url
+
+    # Offer URLs are versioned, so they identify the offer contents
+    version = {
+        'url': index_url,
+        'offers': urls,
+    }
+    if version == cached_version:
+        return cached_version, None
+    return version, urls
+
+def load_regions(config, urls, locations=LOCATIONS):
+    max_workers = int(utils.get_config_value(config, 'PRICING', 'MAX_WORKERS', 4))
+
+    # Locations are resolved before fanning out, and shared read only by the workers
+    locations = types.MappingProxyType(dict(locations))
+
+    def fetch(region):
+        LOGGER.info("Loading {} pricing from {}".format(region, urls[region]))
+        with urlopen(urls[region]) as input:
+            return parse_offer(input, config, locations)
+
+    prices = {}
+    units = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for region_prices in executor.map(fetch, sorted(urls)):
+            units.update(region_prices.pop('units'))
+            for region in region_prices:
+                prices.setdefault(region, {}).update(region_prices[region])
+    prices['units'] = units
+    return prices
+
+def parse_offer(stream, config, locations=LOCATIONS):
+    chunk_size = int(utils.get_config_value(config, 'PRICING', 'CHUNK_SIZE', 100000))
+    reader = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+    # Find header row
+    header = None
+    while header is None:
+        line = reader.readline()
+        if line == '':
+            raise ValueError('Pricing offer is missing its header row')
+        row = next(csv.reader([line], utils.CsvDialect()))
+        if row[0] == "SKU":
+            header = row
+
+    # Only the columns we use are materialized, and only one chunk of rows at a time.  Peak memory is bounded by
+    # chunk_size and the number of distinct prices, not by the size of the offer file.
+    chunks = pd.read_csv(reader, header=None, names=header, usecols=OFFER_COLUMNS, dtype=str, na_filter=False,
+                         skipinitialspace=True, chunksize=chunk_size)
+
+    rowcount = 0
+    prices = {}
+    units = {}
+    skus = {}
+    skipped = set()
+    for chunk in chunks:
+        chunk = chunk[check_rows(chunk)]
+        if len(chunk) == 0:
+            continue
+
+        # Resolve the AWS Region from location information, see resolve_locations.
+        regions = dict((location, locations.get(location, '')) for location in chunk['Location'].unique())
+        for location, region in regions.items():
+            if region == '' and location not in skipped:
+                skipped.add(location)
+                LOGGER.info('Skipping unknown location: {}'.format(location))
+        region = chunk['Location'].map(regions)
+        chunk = chunk.assign(region=region)[region != '']
+        chunk = chunk.assign(key=chunk['region'] + '|' + chunk['Instance Type'] + '|' + chunk['Tenancy'] + '|' +
+                                 chunk['Operating System'])
+
+        # Populate result set.  The first row seen for each price determines its sku.
+        skip = []
+        new_keys = chunk[~chunk['key'].isin(skus)].drop_duplicates('key')
+        for index, key, sku, size in zip(new_keys.index, new_keys['key'], new_keys['SKU'],
+                                         new_keys[NORMALIZATION_COLUMN]):
+            region, instanceType, tenancy, operatingsystem = key.split('|')
+            skus[key] = sku
+            prices.setdefault(region, {}).setdefault(instanceType, {}).setdefault(tenancy, {})[operatingsystem] = {
+                "sku": sku,
+                "reserved": {}
+            }
+            try:
+                units[instanceType] = float(size)
+            except ValueError as e:
+                LOGGER.warning('Invalid pricing data: {}:{} -> {}'.format(region, instanceType, sku))
+                skip.append(index)
+        chunk = chunk.drop(skip)
+
+        expected = chunk['key'].map(skus)
+        duplicates = chunk[chunk['SKU'] != expected].drop_duplicates(['key', 'SKU'])
+        for key, sku in zip(duplicates['key'], duplicates['SKU']):
+            LOGGER.warning('Duplicate sku: {} -> {} != {}'.format(':'.join(key.split('|')[:2]), sku, skus[key]))
+        chunk = chunk[chunk['SKU'] == expected]
+        hourly = chunk['Unit'].isin(['Hrs', 'Hours'])
+
+        # Add pricing data.  Later rows overwrite earlier ones, as they would when applied one row at a time.
+        ondemand = chunk[(chunk['TermType'] == 'OnDemand') & hourly].drop_duplicates('key', keep='last')
+        for key, rate in zip(ondemand['key'], ondemand['PricePerUnit'].astype(float)):
+            get_price(prices, key)['onDemandRate'] = rate
+
+        reserved = chunk[chunk['TermType'] == 'Reserved']
+        reserved = reserved.assign(id=reserved['LeaseContractLength'] + '-' + reserved['OfferingClass'] + '-' +
+                                      reserved['PurchaseOption'])
+        for key, id in zip(*reserved.drop_duplicates(['key', 'id'])[['key', 'id']].values.T):
+            get_price(prices, key)['reserved'].setdefault(id, { 'upfront': 0.0, 'hourly': 0.0 })
+        for field, mask in (('hourly', hourly), ('upfront', chunk['Unit'] == 'Quantity')):
+            rates = reserved[mask[reserved.index]].drop_duplicates(['key', 'id'], keep='last')
+            for key, id, rate in zip(rates['key'], rates['id'], rates['PricePerUnit'].astype(float)):
+                get_price(prices, key)['reserved'][id][field] = rate
+
+        rowcount += len(chunk)
+    LOGGER.info("Loaded {} pricing rows".format(rowcount))
+
+    # Trim useless data
+    rowcount = 0
+    remove = []
+    for region in prices:
+        for instanceType in prices[region]:
+            for tenancy in prices[region][instanceType]:
+                for operatingsystem in prices[region][instanceType][tenancy]:
+                    if 'onDemandRate' not in prices[region][instanceType][tenancy][operatingsystem] or \
+                            len(prices[region][instanceType][tenancy][operatingsystem]['reserved']) == 0:
+                        remove.append([region, instanceType, tenancy, operatingsystem])
+                    else:
+                        rowcount += 1
+    for keys in remove:
+        del prices[keys[0]][keys[1]][keys[2]][keys[3]]
+    prices['units'] = units
+    LOGGER.info("Loaded prices for {} instance types".format(rowcount))
+    return prices
+
+def get_price(prices, key):
+    region, instanceType, tenancy, operatingsystem = key.split('|')
+    return prices[region][instanceType][tenancy][operatingsystem]
+
+def check_rows(chunk):
+    
+    mask = chunk['Product Family'].isin(['Compute Instance', 'Compute Instance (bare metal)'])
+    ###################
+    #
+    # meckstmd: 07/25/2019
+    #
+    # These metal instance types have a Product Family of "Compute Instance (bare metal)"
+    #     i3.metal
+    #     r5.metal
+    #     r5d.metal
+    #     z1d.metal
+    #
+    # These metal instance types have a Product Family of "Compute Instance"
+    #     c5.metal
+    #     m5.metal
+    #     m5d.metal
+    #
+    #  From AWS Support Case #6286484301:
+    #   There is no difference in the two families apart from the ones listed in the EC2 instance types 
+    #   details page (https://aws.amazon.com/ec2/instance-types/). There seems to be an overlap of some 
+    #   kind when new instance types were added and that is why you see them differentiated into two families.
+    #   You can ignore this difference in classification for now and once the errors are rectified at our 
+    #   end, you should not see the two families.
+    #
+    ###################
+    mask &= chunk['serviceCode'] == 'AmazonEC2'
+    mask &= chunk['Location Type'] == 'AWS Region'
+    mask &= chunk['operation'].str.startswith('RunInstances')
+    mask &= chunk['License Model'] == 'No License required'
+    mask &= chunk['Pre Installed S/W'] == 'NA'
+    mask &= chunk['instanceSKU'] == '' # Items with instancesku are children of the item we actually want
+    return mask
 
-            # Add pricing data
-            if row[header_map['TermType']] == 'OnDemand':
-                if row[header_map['Unit']] in ('Hrs', 'Hours'):
-                    price['onDemandRate'] = float(row[header_map['PricePerUnit']])
-            elif row[header_map['TermType']] == 'Reserved':
-                id = '{}-{}-{}'.format(row[header_map['LeaseContractLength']], row[header_map['OfferingClass']],
-                                       row[header_map['PurchaseOption']])
-                if id not in price['reserved']:
-                    price['reserved'][id] = { 'upfront': 0.0, 'hourly': 0.0 }
-                if row[header_map['Unit']] in ('Hrs', 'Hours'):
-                    price['reserved'][id]['hourly'] = float(row[header_map['PricePerUnit']])
-                elif row[header_map['Unit']] in ('Quantity'):
-                    price['reserved'][id]['upfront'] = float(row[header_map['PricePerUnit']])
-
-            rowcount += 1
-        LOGGER.info("Loaded {} pricing rows".format(rowcount))
-
-        # Trim useless data
-        rowcount = 0
-        remove = []
+# Binary cache layout: CACHE_MAGIC, the little-endian length of a JSON header, the JSON header padded to
+# CACHE_ALIGNMENT, then the PricingTable records.  String columns are stored as codes into the header's
+# dictionaries and reserved rates as one column per reservation id, NaN where the offering is not available.
+CACHE_MAGIC = b'ARIELPRC'
+CACHE_ALIGNMENT = 64
+
+def cache_dtype(sku_width, reserved_count):
+    return np.dtype([
+        ('region', '<i4'),
+        ('instancetype', '<i4'),
+        ('tenancy', '<i4'),
+        ('operatingsystem', '<i4'),
+        ('sku', 'S{}'.format(max(sku_width, 1))),
+        ('onDemandRate', '<f8'),
+        ('upfront', '<f8', (reserved_count,)),
+        ('hourly', '<f8', (reserved_count,)),
+    ])
+
+PRICE_COLUMNS = ['region', 'instancetype', 'tenancy', 'operatingsystem']
+
+class PricingTable(object):
+    """EC2 prices by (region, instancetype, tenancy, operatingsystem), indexed for scalar and vectorized lookups."""
+
+    def __init__(self, codes, reserved, units, data):
+        self.codes = codes
+        self.reserved = reserved
+        self.units = units
+        self.data = data
+
+        # Integer codes for each string column, and a sorted combined key over all four
+        self.code_index = {column: {value: code for code, value in enumerate(codes[column])}
+                           for column in PRICE_COLUMNS}
+        self.reserved_index = {id: j for j, id in enumerate(reserved)}
+        self.sizes = [len(codes[column]) for column in PRICE_COLUMNS]
+        keys = self.combine([np.asarray(data[column], dtype=np.int64) for column in PRICE_COLUMNS])
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+        # Normalization units by instance type, and by bare size (first instance type with that suffix)
+        self.suffix_units = {}
+        for instancetype, value in units.items():
+            parts = instancetype.split('.')
+            for i in range(1, len(parts)):
+                self.suffix_units.setdefault('.'.join(parts[i:]), value)
+
+        # Priced instance types by region and family, in table order
+        self.family_types = {}
+        regions = [codes['region'][code] for code in data['region'].tolist()]
+        instancetypes = [codes['instancetype'][code] for code in data['instancetype'].tolist()]
+        for region, instancetype in zip(regions, instancetypes):
+            family = instancetype.split('.')[0]
+            self.family_types.setdefault(region, {}).setdefault(family, {}).setdefault(instancetype, None)
+
+    def combine(self, codes):
+        keys = np.zeros(len(codes[0]), dtype=np.int64)
+        for column_codes, size in zip(codes, self.sizes):
+            keys = keys * size + column_codes
+        return keys
+
+    @classmethod
+    def from_dict(cls, prices):
+        codes = {column: {} for column in PRICE_COLUMNS}
+        reserved = {}
+        entries = []
         for region in prices:
+            if region == 'units':
+                continue
             for instanceType in prices[region]:
                 for tenancy in prices[region][instanceType]:
-                    for operatingsystem in prices[region][instanceType][tenancy]:
-                        if 'onDemandRate' not in prices[region][instanceType][tenancy][operatingsystem] or \
-                                len(prices[region][instanceType][tenancy][operatingsystem]['reserved']) == 0:
-                            remove.append([region, instanceType, tenancy, operatingsystem])
-                        else:
-                            rowcount += 1
-        for keys in remove:
-            del prices[keys[0]][keys[1]][keys[2]][keys[3]]
-        prices['units'] = units
-        LOGGER.info("Loaded prices for {} instance types".format(rowcount))
-
-        with open(cache_file, 'w') as outfile:
-            json.dump(prices, outfile, indent=4)
-        return prices
+                    for operatingsystem, price in prices[region][instanceType][tenancy].items():
+                        entry = [codes[column].setdefault(value, len(codes[column]))
+                                 for column, value in zip(PRICE_COLUMNS, (region, instanceType, tenancy, operatingsystem))]
+                        for id in price['reserved']:
+                            reserved.setdefault(id, len(reserved))
+                        entries.append((entry, price))
+
+        sku_width = max([len(price['sku']) for entry, price in entries] + [1])
+        data = np.zeros(len(entries), cache_dtype(sku_width, len(reserved)))
+        data['upfront'] = np.nan
+        data['hourly'] = np.nan
+        for i, (entry, price) in enumerate(entries):
+            record = data[i]
+            for column, code in zip(PRICE_COLUMNS, entry):
+                record[column] = code
+            record['sku'] = price['sku'].encode('utf-8')
+            record['onDemandRate'] = price.get('onDemandRate', np.nan)
+            for id, rate in price['reserved'].items():
+                record['upfront'][reserved[id]] = rate['upfront']
+                record['hourly'][reserved[id]] = rate['hourly']
 
-    with utils.get_read_handle(cache_file) as input:
-        prices = json.load(input)
+        return cls({column: list(codes[column]) for column in PRICE_COLUMNS}, list(reserved),
+                   dict(prices.get('units', {})), data)
+
+    def to_dict(self):
+        codes = self.codes
+        regions = [codes['region'][code] for code in self.data['region'].tolist()]
+        instanceTypes = [codes['instancetype'][code] for code in self.data['instancetype'].tolist()]
+        tenancies = [codes['tenancy'][code] for code in self.data['tenancy'].tolist()]
+        operatingsystems = [codes['operatingsystem'][code] for code in self.data['operatingsystem'].tolist()]
+        skus = [sku.decode('utf-8') for sku in self.data['sku'].tolist()]
+        ondemand = self.data['onDemandRate'].tolist()
+        upfront = self.data['upfront'].tolist()
+        hourly = self.data['hourly'].tolist()
+
+        prices = {}
+        for i in range(len(self.data)):
+            price = {
+                "sku": skus[i],
+                "reserved": {id: {'upfront': upfront[i][j], 'hourly': hourly[i][j]}
+                             for j, id in enumerate(self.reserved) if not math.isnan(hourly[i][j])},
+            }
+            if not math.isnan(ondemand[i]):
+                price['onDemandRate'] = ondemand[i]
+            prices.setdefault(regions[i], {}).setdefault(instanceTypes[i], {}).setdefault(tenancies[i], {})[operatingsystems[i]] = price
+        prices['units'] = dict(self.units)
         return prices
 
-def check_row(header_map, row):
-    
-    if row[header_map['Product Family']] not in ['Compute Instance', 'Compute Instance (bare metal)']:        
-        ###################
-        #
-        # meckstmd: 07/25/2019
-        #
-        # These metal instance types have a Product Family of "Compute Instance (bare metal)"
-        #     i3.metal
-        #     r5.metal
-        #     r5d.metal
-        #     z1d.metal
-        #
-        # These metal instance types have a Product Family of "Compute Instance"
-        #     c5.metal
-        #     m5.metal
-        #     m5d.metal
-        #
-        #  From AWS Support Case #6286484301:
-        #   There is no difference in the two families apart from the ones listed in the EC2 instance types 
-        #   details page (https://aws.amazon.com/ec2/instance-types/). There seems to be an overlap of some 
-        #   kind when new instance types were added and that is why you see them differentiated into two families.
-        #   You can ignore this difference in classification for now and once the errors are rectified at our 
-        #   end, you should not see the two families.
-        #
-        ###################
-        return False
-    if row[header_map['serviceCode']] != 'AmazonEC2':
-        return False
-    if row[header_map['Location Type']] != 'AWS Region':
-        return False
-    if not row[header_map['operation']].startswith('RunInstances'):
-        return False
-    if row[header_map['License Model']] != 'No License required':
-        return False
-    if row[header_map['Pre Installed S/W']] != 'NA':
-        return False
-    if row[header_map['instanceSKU']] != '': # Items with instancesku are children of the item we actually want
-        return False
-    return True
+    def __contains__(self, region):
+        return region in self.family_types
+
+    def regions(self):
+        return sorted(self.family_types)
+
+    def instance_types(self, region):
+        return [instancetype for types in self.family_types.get(region, {}).values() for instancetype in types]
+
+    def get_units(self, instancetype):
+        # Accepts either an instance type or a bare size, such as xlarge
+        try:
+            return self.units[instancetype]
+        except KeyError as e:
+            if '.' in instancetype or instancetype not in self.suffix_units:
+                raise e
+            return self.suffix_units[instancetype]
+
+    def units_of(self, instancetypes):
+        return pd.Series(instancetypes).astype(object).map(self.units).values.astype(float)
+
+    def family_sizes(self, region, family):
+        # Instance types without a normalization factor can not be purchased by size
+        return {instancetype: self.units[instancetype]
+                for instancetype in self.family_types.get(region, {}).get(family, {}) if instancetype in self.units}
+
+    def reference_sizes(self, families, sizes, region='us-east-1'):
+        # First size in sizes that is priced for each family
+        reference_sizes = {}
+        for family in families:
+            for size in sizes:
+                if "{}.{}".format(family, size) in self.family_types.get(region, {}).get(family, {}):
+                    reference_sizes[family] = size
+                    break
+        return reference_sizes
+
+    def find(self, regions, instancetypes, tenancies, operatingsystems):
+        # Record number of each price, or -1 if missing
+        codes = []
+        for column, values in zip(PRICE_COLUMNS, (regions, instancetypes, tenancies, operatingsystems)):
+            codes.append(pd.Categorical(np.asarray(values, dtype=object), categories=self.codes[column]).codes.astype(np.int64))
+        keys = self.combine(codes)
+        if len(self.sorted_keys) == 0:
+            return np.full(len(keys), -1)
+        missing = np.any([column_codes < 0 for column_codes in codes], axis=0)
+        positions = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.sorted_keys) - 1)
+        found = (self.sorted_keys[positions] == keys) & ~missing
+        return np.where(found, self.order[positions], -1)
+
+    def lookup(self, regions, instancetypes, tenancies, operatingsystems, reserved_id=None):
+        # Vectorized on-demand rates and normalization units, plus reserved rates for reserved_id if given
+        rows = self.find(regions, instancetypes, tenancies, operatingsystems)
+        found = rows >= 0
+        records = self.data[np.where(found, rows, 0)] if len(self.data) > 0 else None
+        result = pd.DataFrame({
+            'onDemandRate': np.where(found, records['onDemandRate'], np.nan) if records is not None else np.nan,
+            'units': self.units_of(instancetypes),
+        })
+        if reserved_id is not None:
+            j = self.reserved_index.get(reserved_id)
+            for field in ('upfront', 'hourly'):
+                result[field] = np.where(found, records[field][:, j], np.nan) if j is not None else np.nan
+        return result
+
+    def get_rates(self, region, instancetype, tenancy, operatingsystem):
+        # Rates for a single price in the nested format, or None if missing
+        row = self.find([region], [instancetype], [tenancy], [operatingsystem])[0]
+        if row < 0:
+            return None
+        record = self.data[row]
+        return {
+            'sku': record['sku'].decode('utf-8'),
+            'onDemandRate': float(record['onDemandRate']),
+            'reserved': {id: {'upfront': float(record['upfront'][j]), 'hourly': float(record['hourly'][j])}
+                         for id, j in self.reserved_index.items() if not math.isnan(record['hourly'][j])},
+        }
+
+def save_cache(pricing, filename):
+    header = {
+        'codes': pricing.codes,
+        'reserved': pricing.reserved,
+        'units': pricing.units,
+        'count': len(pricing.data),
+        'sku_width': pricing.data.dtype['sku'].itemsize,
+    }
+    header = json.dumps(header).encode('utf-8')
+    offset = len(CACHE_MAGIC) + 8 + len(header)
+    padding = -offset % CACHE_ALIGNMENT
+
+    # Write to the side and rename, so existing memory maps of the previous file stay valid
+    with open(filename + '.tmp', 'wb') as outfile:
+        outfile.write(CACHE_MAGIC)
+        outfile.write(struct.pack('<Q', len(header)))
+        outfile.write(header)
+        outfile.write(b'\0' * padding)
+        outfile.write(np.ascontiguousarray(pricing.data).tobytes())
+    os.replace(filename + '.tmp', filename)
+
+def load_cache(filename):
+    with open(filename, 'rb') as input:
+        if input.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            raise ValueError('Not an Ariel pricing cache: ' + filename)
+        length, = struct.unpack('<Q', input.read(8))
+        header = json.loads(input.read(length).decode('utf-8'))
+
+    offset = len(CACHE_MAGIC) + 8 + length
+    offset += -offset % CACHE_ALIGNMENT
+    dtype = cache_dtype(header['sku_width'], len(header['reserved']))
+    if header['count'] == 0:
+        data = np.zeros(0, dtype)
+    else:
+        data = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(header['count'],))
+    return PricingTable(header['codes'], header['reserved'], header['units'], data)
 
 def handler(event, context):
     pass
@@ -204,7 +580,7 @@ def cli():
     parser.add_argument('--config', required=True, help='Config file to load for Ariel configuration')
 
     args = parser.parse_args(args=sys.argv[2:])
-    print(yaml.dump(load(utils.load_config(args.config))))
+    print(yaml.dump(load(utils.load_config(args.config)).to_dict()))
 
 if __name__ == '__main__':
     cli()
@@ -2,13 +2,30 @@
 # Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
 from ariel import utils, LOGGER
 
-import boto3
 import datetime
 import os
 import pandas as pd
 import sys
 import time
 
+COLUMNS = {
+    'accountid': 'int64',
+    'accountname': 'category',
+    'state': 'category',
+    'quantity': 'int64',
+    'availabilityzone': 'category',
+    'region': 'category',
+    'instancetype': 'category',
+    'paymentoption': 'category',
+    'tenancy': 'category',
+    'operatingsystem': 'category',
+    'amortizedhours': 'int64',
+    'amortizedupfrontprice': 'float64',
+    'amortizedrecurringfee': 'float64',
+    'offeringclass': 'category',
+    'scope': 'category',
+}
+
 def load(config):
 
     # If local files exists and is less than a day old, just use it.
@@ -38,8 +55,7 @@ def load(config):
 
         ris = []
         if role != '':
-            session = utils.assume_role(boto3.Session(), role)
-            ce = session.client('ce', region_name=region)
+            ce = utils.SESSIONS.client('ce', region, role)
 
             rsp = ce.get_reservation_utilization(
                 TimePeriod={ "Start": str(monthstart), "End": str(monthend) },
@@ -110,6 +126,7 @@ def load(config):
 
         ris.to_csv(cache_file, index=False)
 
+    ris = utils.apply_columns(ris, COLUMNS)
     LOGGER.info("Loaded {} reserved instances".format(len(ris)))
     return ris
 
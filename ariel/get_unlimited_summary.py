@@ -2,95 +2,74 @@
 # Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
 from ariel import utils, LOGGER
 
-import boto3
-import datetime
-import os
 import pandas as pd
 import sys
-import time
 
-def load(config):
+CACHE_FILE = '/tmp/cached-unlimited-summary.csv'
+COLUMNS = {
+    'accountid': 'int64',
+    'region': 'category',
+    'instancetypefamily': 'category',
+    'unlimitedusageamount': 'float64',
+    'unlimitedusagecost': 'float64',
+}
+
+# Presentation of numeric report columns in CSV reports
+FORMATS = {
+    'unlimitedusageamount': '{:.2f}',
+    'unlimitedusagecost': '${:,.2f}',
+}
+
+def query(config):
+    database = utils.get_config_value(config, 'ATHENA', 'CUR_DATABASE')
+    table_name = utils.get_config_value(config, 'ATHENA', 'CUR_TABLE_NAME', 'cur')
+    starttime, endtime = utils.get_time_range(config)
+
+    # Download Instance and RI usage
+    # meckstmd: 07/30/2019 - Something must have changed with the way AWS is exposing CPU Credits.
+    #  There is a line_item_line_item_type column of Tax for each account which has CPU Credits which 
+    #  does not have a product_region or product_instance.  Because these fields are empty, Ariel 
+    #  fails when trying to insert this report data into the unlimited_usage DB table because it does
+    #  not allow nulls.  The line_item_line_item_type column of Usage in this report has the per-instance
+    #  CPU credits for unlimited and does have product_region and product_instance.  I am guessing the
+    #  Tax one was just added to this report and that is what broke Ariel.
+    #  See https://github.com/yahoo/ariel/issues/5
+    query = ' '.join((""
+        + "SELECT line_item_usage_account_id AS accountid ,"
+          "       product_region AS region, "
+          "       lower(product_instance) AS instancetypefamily, "
+          "       sum(line_item_usage_amount) AS unlimitedusageamount, "
+          "       sum(line_item_unblended_cost) AS unlimitedusagecost "
+                      + "  FROM " + database + "." + table_name
+        + " WHERE line_item_usage_type like '%CPUCredits:%' "
+        + "   AND line_item_usage_start_date >= cast('{}' as timestamp) ".format(starttime.isoformat(' '))
+        + "   AND line_item_usage_start_date < cast('{}' as timestamp) ".format(endtime.isoformat(' '))
+        + "   " + utils.get_partition_filter(config, starttime, endtime)
+        + "   AND product_region <> '' AND product_instance <> ''"
+        + " GROUP BY line_item_usage_account_id, product_region, lower(product_instance) "
+        + " ORDER BY line_item_usage_account_id, product_region, lower(product_instance) "
+        ).split())
+    return query
+
+def load(config, athena=None):
 
     # If local files exists and is less than a day old, just use it.
-    cache_file = '/tmp/cached-unlimited-summary.csv'
-    caching = utils.get_config_value(config, 'DEFAULTS', 'CACHING', False)
-    mtime = 0
-    if caching:
-        try:
-            mtime = os.stat(cache_file).st_mtime
-        except FileNotFoundError:
-            mtime = 0
-
-    if mtime > time.time() - 86400:
+    cache_file = CACHE_FILE
+    if utils.is_cache_fresh(config, cache_file):
         LOGGER.info("Using existing cache file: " + cache_file)
+        result = utils.read_csv(cache_file, COLUMNS)
     else:
-        account, role = utils.get_master(config)
-        region   = utils.get_config_value(config, 'ATHENA', 'AWS_REGION',
-                   utils.get_config_value(config, 'DEFAULTS', 'AWS_REGION',
-                                          os.environ.get('AWS_DEFAULT_REGION')))
-        database = utils.get_config_value(config, 'ATHENA', 'CUR_DATABASE')
-        table_name = utils.get_config_value(config, 'ATHENA', 'CUR_TABLE_NAME', 'cur')
-        staging  = utils.get_config_value(config, 'ATHENA', 'STAGING',
-                                          's3://aws-athena-query-results-{0}-{1}/ariel-cur-output/'.format(account, region))
-        days     = utils.get_config_value(config, 'ATHENA', 'DAYS', 28)
-        offset   = utils.get_config_value(config, 'ATHENA', 'OFFSET', 1)
-
-        session = boto3.Session()
-        proto, empty, staging_bucket, staging_prefix = staging.split('/', 3)
-
-        # Assume role if needed
-        if role is not None:
-            session = utils.assume_role(session, role)
-
-        # Connect to Athena
-        athena = session.client('athena', region_name=region)
-
-        # Validate database is usable
-        status_id = utils.execute_athena_query(athena, staging, 'SELECT status FROM ' + database + '.cost_and_usage_data_status')
-
-        # Row 0 is header
-        status = athena.get_query_results(QueryExecutionId=status_id)['ResultSet']['Rows'][1]['Data'][0]['VarCharValue']
-        if status != 'READY':
-            raise Exception('Athena database not in READY status')
-
-        # Identify start to end range query
-        today = datetime.datetime.combine(datetime.datetime.today(), datetime.time.min)
-        endtime = today - datetime.timedelta(days=offset)
-        starttime = endtime - datetime.timedelta(days=days)
-
-        # Download Instance and RI usage
-        # meckstmd: 07/30/2019 - Something must have changed with the way AWS is exposing CPU Credits.
-        #  There is a line_item_line_item_type column of Tax for each account which has CPU Credits which 
-        #  does not have a product_region or product_instance.  Because these fields are empty, Ariel 
-        #  fails when trying to insert this report data into the unlimited_usage DB table because it does
-        #  not allow nulls.  The line_item_line_item_type column of Usage in this report has the per-instance
-        #  CPU credits for unlimited and does have product_region and product_instance.  I am guessing the
-        #  Tax one was just added to this report and that is what broke Ariel.
-        #  See https://github.com/yahoo/ariel/issues/5
-        query = ' '.join((""
-            + "SELECT line_item_usage_account_id AS accountid ,"
-              "       product_region AS region, "
-              "       lower(product_instance) AS instancetypefamily, "
-              "       sum(line_item_usage_amount) AS unlimitedusageamount, "
-              "       sum(line_item_unblended_cost) AS unlimitedusagecost "
-                          + "  FROM " + database + "." + table_name
-            + " WHERE line_item_usage_type like '%CPUCredits:%' "
-            + "   AND line_item_usage_start_date >= cast('{}' as timestamp) ".format(starttime.isoformat(' '))
-            + "   AND line_item_usage_start_date < cast('{}' as timestamp) ".format(endtime.isoformat(' '))
-            + "   AND product_region <> '' AND product_instance <> ''"
-            + " GROUP BY line_item_usage_account_id, product_region, lower(product_instance) "
-            + " ORDER BY line_item_usage_account_id, product_region, lower(product_instance) "
-            ).split())
-        query_id = utils.execute_athena_query(athena, staging, query)
-        session.client('s3').download_file(staging_bucket, '{0}{1}.csv'.format(staging_prefix, query_id), cache_file)
+        if athena is None:
+            athena = utils.AthenaExecutor(config)
+        athena.validate()
+        query_id = athena.execute(query(config))
+        caching = utils.get_config_value(config, 'DEFAULTS', 'CACHING', False)
+        result = athena.read(query_id, COLUMNS, cache_file if caching else None)
 
-    result = pd.read_csv(cache_file)
     if len(result) == 0:
-        result = pd.DataFrame(columns=['accountid', 'region', 'instancetypefamily', 'unlimitedusageamount', 'unlimitedusagecost'])
+        result = utils.apply_columns(pd.DataFrame(columns=list(COLUMNS)), COLUMNS)
 
     result['accountid']            = result['accountid']           .map('{:012}'.format)
-    result['unlimitedusageamount'] = result['unlimitedusageamount'].map('{:.2f}'.format)
-    result['unlimitedusagecost']   = result['unlimitedusagecost']  .map('${:,.2f}'.format)
     LOGGER.info("Loaded {} unlimited rows".format(len(result)))
     return result
 
@@ -102,7 +81,7 @@ def cli():
 
     args = parser.parse_args(args=sys.argv[2:])
     unlimited = load(utils.load_config(args.config))
-    unlimited.to_csv(sys.stdout)
+    utils.format_columns(unlimited, FORMATS).to_csv(sys.stdout)
 
 if __name__ == '__main__':
     cli()
@@ -2,15 +2,56 @@
 # Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
 from ariel import *
 
-import boto3
-import gzip
-import io
-import os
 import pandas as pd
 import pg8000
 import ssl
 import sys
 
+# Configuration each dataset is loaded with.  Configs that agree on these share the loaded dataset.
+MASTER_SETTINGS = [('MASTER', None), ('DEFAULTS', 'AWS_REGION')]
+ATHENA_SETTINGS = MASTER_SETTINGS + [('ATHENA', None)]
+PRICING_SETTINGS = ATHENA_SETTINGS + [('PRICING', None), ('LOCATIONS', None)]
+DATASET_SETTINGS = {
+    'account_names': MASTER_SETTINGS + [('ACCOUNT_NAMES', None)],
+    'locations': ATHENA_SETTINGS,
+    'reserved_instances': MASTER_SETTINGS + [('RESERVED_INSTANCES', None), ('RI_PURCHASES', 'SKIP_ACCOUNTS'),
+                                             ('RI_PURCHASES', 'EXPIRATION_DAYS')],
+    'pricing': PRICING_SETTINGS,
+    # Enriched summaries are computed with pricing
+    'account_instance_summary': PRICING_SETTINGS,
+    'unused_box': ATHENA_SETTINGS,
+    'unlimited': ATHENA_SETTINGS,
+}
+
+# Presentation of numeric report columns in CSV reports
+REPORT_FORMATS = dict(generate_reports.FORMATS, UNUSED_BOX=get_unused_box_summary.FORMATS,
+                      UNLIMITED=get_unlimited_summary.FORMATS)
+
+# Column types of the tables in schema/*.sql, for Parquet reports.  Other columns keep their types.
+UNITS_TYPES = dict([(column, 'int32') for column in generate_reports.USAGE_COLUMNS[:5]] + [('coverage_chance', 'float64')])
+REPORT_TYPES = {
+    'ACCOUNT_INSTANCE_SUMMARY': {
+        'usagestartdate': 'datetime',
+        'usageaccountid': 'account',
+        'instances': 'float64',
+        'reserved': 'float64',
+        'instance_units': 'float64',
+        'reserved_units': 'float64',
+    },
+    'RI_PURCHASES': {'Term': 'int16', 'Quantity': 'int16', 'units': 'float64'},
+    'RI_USAGE': UNITS_TYPES,
+    'RI_HOURLY_USAGE': dict(UNITS_TYPES, hourofweek='int16'),
+    'RI_TRENDS': {'samples': 'int32', 'outliers': 'int32', 'slope': 'float64'},
+    'PROFILE': {'started': 'datetime', 'rows': 'Int64'},
+}
+
+def dataset_key(config, name):
+    # The time range is part of every key, so that configs processed across midnight do not share stale data
+    return utils.DATASETS.key(config, name, DATASET_SETTINGS[name], utils.get_time_range(config))
+
+def load_dataset(config, name, load, *args, **kwargs):
+    return utils.DATASETS.get(dataset_key(config, name), lambda: load(config, *args, **kwargs))
+
 def lambda_main(config):
 
     # TODO Check to see if we've been run recently (DB Not Ready thing)
@@ -19,101 +60,186 @@ def lambda_main(config):
     # TODO Regional Summary to Aurora
     # TODO UnusedBox Summary to Aurora
     # TODO Should Aurora be the storage platform?
+
+    # Profile this run, including the slowest groups of the purchase evaluation
+    profiler = profiling.PROFILER
+    profiler.reset()
+    profiler.slowest_groups = int(utils.get_config_value(config, 'DEFAULTS', 'PROFILE_GROUPS', 10))
+
+    # Start all CUR queries up front, so they run concurrently with each other and the other loaders
+    LOGGER.info("Submitting Athena queries...")
+    with profiler.stage('submit_queries') as stage:
+        athena_loaders = [('locations', get_locations)]
+        if not utils.get_config_value(config, 'ATHENA', 'ENRICH', False):
+            # Enriched summaries are queried once pricing is loaded
+            athena_loaders.append(('account_instance_summary', get_account_instance_summary))
+        if utils.get_config_value(config, 'CSV_REPORTS', 'UNUSED_BOX', '') != '':
+            athena_loaders.append(('unused_box', get_unused_box_summary))
+        if utils.get_config_value(config, 'CSV_REPORTS', 'UNLIMITED', '') != '':
+            athena_loaders.append(('unlimited', get_unlimited_summary))
+        # Datasets already loaded for an earlier config are not queried again
+        queries = [loader.query(config) for name, loader in athena_loaders
+                   if dataset_key(config, name) not in utils.DATASETS and not utils.is_cache_fresh(config, loader.CACHE_FILE)]
+        queries = [query for query in queries if query is not None]
+        athena = None
+        if len(queries) > 0:
+            athena = utils.AthenaExecutor(config)
+            athena.validate()
+            for query in queries:
+                athena.submit(query)
+        stage.rows = len(queries)
+
     LOGGER.info("Loading Account Names...")
-    account_names = get_account_names.load(config)
+    with profiler.stage('account_names') as stage:
+        account_names = load_dataset(config, 'account_names', get_account_names.load)
+        stage.rows = len(account_names)
     LOGGER.info("Loaded {} accounts".format(len(account_names)))
 
     LOGGER.info("Loading Locations...")
-    locations = get_locations.load(config)
+    with profiler.stage('locations') as stage:
+        locations = load_dataset(config, 'locations', get_locations.load, athena)
+        stage.rows = len(locations)
     LOGGER.info("Loaded {} locations".format(len(locations)))
 
     LOGGER.info("Loading Reserved Instances...")
-    ris = get_reserved_instances.load(config)
+    with profiler.stage('reserved_instances') as stage:
+        ris = load_dataset(config, 'reserved_instances', get_reserved_instances.load)
+        stage.rows = len(ris)
     LOGGER.info("Loaded {} RI Subcriptions".format(len(ris)))
 
     LOGGER.info("Loading EC2 Pricing Data...")
-    pricing = get_ec2_pricing.load(config, locations = locations)
-    for region in sorted(pricing):
-        LOGGER.info("Loaded prices for {} instance types in {}".format(len(pricing[region]), region))
+    with profiler.stage('pricing') as stage:
+        pricing = load_dataset(config, 'pricing', get_ec2_pricing.load, locations=locations)
+        stage.rows = len(pricing.data)
+    for region in pricing.regions():
+        LOGGER.info("Loaded prices for {} instance types in {}".format(len(pricing.instance_types(region)), region))
 
     LOGGER.info("Querying CUR data from Athena...")
-    instances = get_account_instance_summary.load(config)
+    with profiler.stage('account_instance_summary') as stage:
+        instances = load_dataset(config, 'account_instance_summary', get_account_instance_summary.load, athena, pricing)
+        stage.rows = len(instances)
 
     LOGGER.info("Generating Reports...")
-    reports = generate_reports.generate(config, instances, ris, pricing)
+    with profiler.stage('generate'):
+        reports = generate_reports.generate(config, instances, ris, pricing)
 
     LOGGER.info("Generating Unused Box report")
     if utils.get_config_value(config, 'CSV_REPORTS', 'UNUSED_BOX', '') != '':
-        reports['UNUSED_BOX'] = get_unused_box_summary.load(config)
+        with profiler.stage('unused_box') as stage:
+            # Publishing decorates reports in place, so shared datasets are published as copies
+            reports['UNUSED_BOX'] = load_dataset(config, 'unused_box', get_unused_box_summary.load, athena).copy()
+            stage.rows = len(reports['UNUSED_BOX'])
 
     LOGGER.info("Generating Unlimited report")
     if utils.get_config_value(config, 'CSV_REPORTS', 'UNLIMITED', '') != '':
-        reports['UNLIMITED'] = get_unlimited_summary.load(config)
+        with profiler.stage('unlimited') as stage:
+            reports['UNLIMITED'] = load_dataset(config, 'unlimited', get_unlimited_summary.load, athena).copy()
+            stage.rows = len(reports['UNLIMITED'])
 
     LOGGER.info("Publishing Reports...")
-    pgdb = utils.get_config_value(config, 'PG_REPORTS', 'DB_HOST', '')
-    if pgdb != '':
-        ca_cache = '/tmp/cached-rds-ca.pem'
-        boto3.resource('s3').Bucket('rds-downloads').download_file('rds-ca-2019-root.pem', ca_cache)
-        ssl_context = ssl.SSLContext()
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-        ssl_context.load_verify_locations(ca_cache)
-        connect_host = utils.get_config_value(config, 'PG_REPORTS', 'CONNECT_HOST', pgdb)
-        token = boto3.client('rds').generate_db_auth_token(pgdb, 5432, 'ariel_rw')
-        conn = pg8000.connect(host=connect_host, port=5432, ssl_context=ssl_context, database='ariel', user='ariel_rw', password=token)
-
-    for key, report in reports.items():
-        store_index = type(report.index) != pd.RangeIndex and len(report) > 0
-        filename = utils.get_config_value(config, 'CSV_REPORTS', key, '')
-        if filename != '':
-            LOGGER.info("Writing Report {} to {}...".format(key, filename))
-
-            # Decorate report
-            if 'accountid' in report.columns and 'accountname' not in report.columns:
-                accountname_column = report.columns.get_loc('accountid') + 1
-                input_column = 'Account ID' if 'Account ID' in report.columns else 'accountid'
-                accountname_value = report[input_column].apply(lambda x: account_names[x] if x in account_names else x)
-                report.insert(accountname_column, 'accountname', accountname_value)
-
-            # Write report
-            with utils.get_temp_write_handle(filename) as output:
-                report.to_csv(output, index=store_index)
-
+    with profiler.stage('publish'):
+        conn = None
+        pgdb = utils.get_config_value(config, 'PG_REPORTS', 'DB_HOST', '')
         if pgdb != '':
-            tablename = utils.get_config_value(config, 'PG_REPORTS', key, '')
-            if tablename != '':
-                LOGGER.info("Writing Report {} to {}.{}...".format(key, pgdb, tablename))
-                with conn.cursor() as cursor:
-                    if key == 'ACCOUNT_INSTANCE_SUMMARY':
-                        start = report.reset_index()['usagestartdate'].min()
-                        cursor.execute('DELETE FROM {} WHERE usagestartdate >= %s'.format(tablename), [start])
-                    else:
-                        cursor.execute('TRUNCATE TABLE {}'.format(tablename))
-
-                    report_cache = '/tmp/cached-report.csv.gz'
-                    with gzip.open(report_cache, 'wb') as writer:
-                        report.to_csv(io.TextIOWrapper(writer, write_through=True), index=store_index)
-                    with gzip.open(report_cache, 'rb') as reader:
-                        cursor.execute("COPY {} FROM STDIN WITH CSV HEADER".format(tablename), stream=reader)
-                    os.remove(report_cache)
-                    conn.commit()
+            ca_cache = '/tmp/cached-rds-ca.pem'
+            utils.SESSIONS.client('s3').download_file('rds-downloads', 'rds-ca-2019-root.pem', ca_cache)
+            ssl_context = ssl.SSLContext()
+            ssl_context.verify_mode = ssl.CERT_REQUIRED
+            ssl_context.load_verify_locations(ca_cache)
+            connect_host = utils.get_config_value(config, 'PG_REPORTS', 'CONNECT_HOST', pgdb)
+            token = utils.SESSIONS.client('rds').generate_db_auth_token(pgdb, 5432, 'ariel_rw')
+            conn = pg8000.connect(host=connect_host, port=5432, ssl_context=ssl_context, database='ariel', user='ariel_rw', password=token)
+
+        for key, report in reports.items():
+            with profiler.stage(key.lower()) as stage:
+                publish_report(config, key, report, account_names, conn)
+                stage.rows = len(report)
+
+    # The profile itself is published last, so it covers publishing the other reports
+    LOGGER.info("Run profile: " + profiler.to_json())
+    publish_report(config, 'PROFILE', profiler.report(), account_names, conn)
     LOGGER.info("Reports Complete")
 
 
+def get_report_format(config, key, filename):
+    # Set per report, e.g. RI_HOURLY_USAGE_FORMAT: parquet, or by the file extension
+    default = 'parquet' if filename.endswith('.parquet') else 'csv'
+    return str(utils.get_config_value(config, 'CSV_REPORTS', key + '_FORMAT', default)).lower()
+
+def publish_report(config, key, report, account_names, conn=None):
+    store_index = type(report.index) != pd.RangeIndex and len(report) > 0
+    filename = utils.get_config_value(config, 'CSV_REPORTS', key, '')
+    if filename != '':
+        LOGGER.info("Writing Report {} to {}...".format(key, filename))
+
+        # Decorate report
+        if 'accountid' in report.columns and 'accountname' not in report.columns:
+            accountname_column = report.columns.get_loc('accountid') + 1
+            input_column = 'Account ID' if 'Account ID' in report.columns else 'accountid'
+            accountname_value = report[input_column].apply(lambda x: account_names[x] if x in account_names else x)
+            report.insert(accountname_column, 'accountname', accountname_value)
+
+        report_format = get_report_format(config, key, filename)
+        if report_format == 'parquet':
+            # Typed like the database table, with the index as columns so that Athena and Spark can read them
+            output_report = utils.type_columns(report.reset_index() if store_index else report, REPORT_TYPES.get(key, {}))
+            compression = utils.get_config_value(config, 'CSV_REPORTS', 'PARQUET_COMPRESSION', 'snappy')
+            row_group_size = int(utils.get_config_value(config, 'CSV_REPORTS', 'PARQUET_ROW_GROUP_SIZE', 1000000))
+            with utils.get_temp_write_handle(filename, 'wb') as output:
+                # Microsecond timestamps, like Postgres, are readable by older Parquet readers than nanoseconds
+                output_report.to_parquet(output, engine='pyarrow', index=False, row_group_size=row_group_size,
+                                         compression=None if compression == 'none' else compression,
+                                         coerce_timestamps='us', allow_truncated_timestamps=True)
+        elif report_format == 'csv':
+            # Write report, formatted for people unless disabled
+            output_report = report
+            if utils.get_config_value(config, 'CSV_REPORTS', 'FORMATTED', True):
+                output_report = utils.format_columns(report, REPORT_FORMATS.get(key, {}))
+            with utils.get_temp_write_handle(filename) as output:
+                output_report.to_csv(output, index=store_index)
+        else:
+            raise ValueError('Unknown format {} for report {}, expected csv or parquet'.format(report_format, key))
+
+    if conn is not None:
+        pgdb = utils.get_config_value(config, 'PG_REPORTS', 'DB_HOST', '')
+        tablename = utils.get_config_value(config, 'PG_REPORTS', key, '')
+        if tablename != '':
+            LOGGER.info("Writing Report {} to {}.{}...".format(key, pgdb, tablename))
+            with conn.cursor() as cursor:
+                if key == 'ACCOUNT_INSTANCE_SUMMARY':
+                    start = report.reset_index()['usagestartdate'].min()
+                    cursor.execute('DELETE FROM {} WHERE usagestartdate >= %s'.format(tablename), [start])
+                elif key != 'PROFILE':
+                    # Profiles are kept for every run
+                    cursor.execute('TRUNCATE TABLE {}'.format(tablename))
+
+                # Numbers are written as is, except those shown without decimals, which have int columns
+                # CSV is encoded a batch of rows at a time, as pg8000 sends it, rather than all up front
+                batch_rows = int(utils.get_config_value(config, 'PG_REPORTS', 'COPY_BATCH_ROWS', 10000))
+                chunks = utils.iter_csv(utils.round_columns(report, REPORT_FORMATS.get(key, {})), store_index, batch_rows)
+                cursor.execute("COPY {} FROM STDIN WITH CSV HEADER".format(tablename), stream=utils.ChunkReader(chunks))
+                conn.commit()
+
+
 def handler(event, context):
     # Allow for multiple configs to be processed sequentially
-    # NOTE: Data caching highly recommended when using multiple configs
+    # NOTE: Configs that share data sources also share the data loaded for the first of them
     configs = event['config'].split(',')
-    for config in configs:
-        lambda_main(utils.load_config(config))
+    try:
+        for config in configs:
+            lambda_main(utils.load_config(config))
+    finally:
+        # Warm Lambda containers keep module state, so nothing is reused across invocations
+        utils.DATASETS.clear()
+        utils.QUERY_CACHE.clear()
 
 def cli():
     import argparse
     parser = argparse.ArgumentParser(prog='{} {}'.format(*(sys.argv[0], sys.argv[1])))
-    parser.add_argument('--config', required=True, help='Config file to load for Ariel configuration')
+    parser.add_argument('--config', required=True, help='Config file, or comma separated config files, to load for Ariel configuration')
 
     args = parser.parse_args(args=sys.argv[2:])
-    lambda_main(utils.load_config(args.config))
+    handler({'config': args.config}, None)
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,113 @@
+# Copyright 2019, Oath Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+from ariel import LOGGER
+
+import contextlib
+import heapq
+import json
+import pandas as pd
+import resource
+import sys
+import threading
+import time
+
+COLUMNS = ['started', 'stage', 'wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'rows']
+
+
+def get_cpu_time():
+    # CPU time of this process and of its finished worker processes
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(rusage.ru_utime + rusage.ru_stime for rusage in usage)
+
+
+def get_peak_rss():
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0 / 1024.0 if sys.platform == 'darwin' else peak / 1024.0
+
+
+class Stage(object):
+    """Measurements of one stage of a run.  Set rows to the number of rows the stage produced."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_mb = None
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'peak_rss_mb': self.peak_rss_mb,
+            'rows': self.rows,
+        }
+
+
+class Profiler(object):
+    """Wall time, CPU time, peak RSS and row counts of the stages of a run, and its slowest groups."""
+
+    def __init__(self, slowest_groups=10):
+        self.slowest_groups = slowest_groups
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = []
+        self.groups = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Nested stages are named after their parents, e.g. generate/allocate
+        parents = getattr(self.local, 'parents', [])
+        self.local.parents = parents + [name]
+        stage = Stage('/'.join(self.local.parents))
+        wall, cpu = time.perf_counter(), get_cpu_time()
+        try:
+            yield stage
+        finally:
+            self.local.parents = parents
+            stage.wall_seconds = time.perf_counter() - wall
+            stage.cpu_seconds = get_cpu_time() - cpu
+            stage.peak_rss_mb = get_peak_rss()
+            with self.lock:
+                self.stages.append(stage)
+            LOGGER.debug("Stage {} took {:.3f}s".format(stage.name, stage.wall_seconds))
+
+    def add_group(self, group, seconds):
+        # Keeps the slowest groups only
+        entry = (seconds, '/'.join(str(key) for key in group))
+        with self.lock:
+            if len(self.groups) < self.slowest_groups:
+                heapq.heappush(self.groups, entry)
+            elif self.slowest_groups > 0:
+                heapq.heappushpop(self.groups, entry)
+
+    def get_groups(self):
+        return sorted(self.groups, reverse=True)
+
+    def report(self):
+        # Stages in completion order, followed by the slowest groups, all labeled with the start of the run
+        stages = [stage.as_dict() for stage in self.stages]
+        groups = [{'stage': 'group/' + group, 'wall_seconds': seconds} for seconds, group in self.get_groups()]
+        report = pd.DataFrame(stages + groups, columns=COLUMNS).astype({'rows': 'Int64'})
+        report['started'] = self.get_started()
+        return report
+
+    def get_started(self):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started))
+
+    def to_json(self):
+        return json.dumps({
+            'started': self.get_started(),
+            'stages': [stage.as_dict() for stage in self.stages],
+            'slowest_groups': [{'group': group, 'wall_seconds': seconds} for seconds, group in self.get_groups()],
+        })
+
+
+# Profile of the current run
+PROFILER = Profiler()
@@ -0,0 +1,46 @@
+# Copyright 2019, Oath Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+import numpy as np
+import pandas as pd
+
+
+def demand_index(length, target_utilization):
+    # Position in the sorted demand that is covered target_utilization percent of the time
+    return int(length * (100 - target_utilization) / 100)
+
+
+class DemandCurve(object):
+    """Demand of a group sorted once, for the demand at any target utilization and prior purchases."""
+
+    def __init__(self, demand):
+        self.demand = np.asarray(demand, dtype=np.float64)
+
+        # Subtracting prior purchases does not change the order, unless NaN leaves the order undefined
+        # Groups are evaluated at up to 4 targets, standard and convertible in account and slush, and BREAK_EVEN
+        # targets are only known per rate.  Selecting that many positions with np.partition is no faster than one
+        # sort at the hours of a usage window, so the demand is sorted once and every target is read from it.
+        self.sorted = np.sort(self.demand) if not np.isnan(self.demand).any() else None
+
+    def at(self, target_utilization, prior_units=0):
+        index = demand_index(len(self.demand), target_utilization)
+        if self.sorted is None:
+            return sorted(self.demand - prior_units)[index]
+        return self.sorted[index] - prior_units
+
+
+class AccountQuantiles(object):
+    """Percentiles of the daily usage of each account, for all target utilizations in one pass."""
+
+    def __init__(self, account_daily_usage, timerange, target_utilizations):
+        # Days without usage count as 0, so that accounts with usage in part of the timerange are not overestimated
+        accounts = np.sort(account_daily_usage.index.get_level_values(0).unique())
+        index = pd.MultiIndex.from_product([accounts, timerange], names=account_daily_usage.index.names)
+        usage = account_daily_usage.reindex(index, fill_value=0.0).values.reshape(len(accounts), len(timerange))
+
+        self.targets = sorted(set(target_utilizations))
+        percentiles = np.percentile(usage, q=[100 - target for target in self.targets], axis=1)
+        self.percentiles = dict((target, pd.Series(percentiles[row], index=pd.Index(accounts, name='usageaccountid')))
+                                for row, target in enumerate(self.targets))
+
+    def get(self, target_utilization):
+        return self.percentiles[target_utilization]
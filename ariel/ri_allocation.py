@@ -0,0 +1,297 @@
+# Copyright 2019, Oath Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+from ariel import LOGGER
+
+import numpy as np
+import pandas as pd
+
+# Width of all hour of week arrays
+HOURS = 168
+
+REGION_KEYS = ['region', 'instancetypefamily', 'tenancy', 'operatingsystem']
+AZ_KEYS = ['availabilityzone', 'instancetype', 'tenancy', 'operatingsystem']
+
+# Account that cross-account AZ RI usage is booked to
+CROSS_ACCOUNT = '000000000000'
+
+# NOTE: For usage values, AZ usage is booked by quantity (instances), Region usage is booked by units.
+# Hour of week arrays hold NaN for hours without usage, matching the labels pandas would have left out.  Sums over
+# several rows use the compensated summation of pandas groupby sums, so that results match it exactly.
+
+
+class KeyIndex(object):
+    """Row numbers for the observed keys of a groupby, in sorted key order."""
+
+    def __init__(self, frame, keys):
+        grouped = frame.groupby(keys, observed=True)
+        self.codes = grouped.ngroup().values
+        self.keys = list(grouped.size().index)
+        self.rows = dict((key, row) for row, key in enumerate(self.keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key):
+        return self.rows.get(key, -1)
+
+    def remap(self, rows):
+        # Codes renumbered to the position of their row in rows, -1 for rows not included
+        mapping = np.full(len(self.keys) + 1, -1)
+        mapping[rows] = np.arange(len(rows))
+        return mapping[self.codes]
+
+
+class InstanceUsage(object):
+    """Instance units by (region, family, tenancy, operatingsystem) group and hour, for slicing out one group."""
+
+    def __init__(self, instances):
+        self.groups = KeyIndex(instances, REGION_KEYS)
+        codes = pd.Series(self.groups.codes, index=instances.index, name='group')
+        self.daily = instances.groupby([codes, 'usagestartdate', 'hourofweek'], observed=True)['instance_units'].sum()
+        self.account_daily = instances.groupby([codes, 'usageaccountid', 'usagestartdate'],
+                                               observed=True)['instance_units'].sum()
+
+        # Hour of week mean of the hourly totals, as in generate_reports
+        self.hourly = np.full((len(self.groups), HOURS), np.nan)
+        mean = self.daily.groupby(level=['group', 'hourofweek']).mean()
+        self.hourly[mean.index.get_level_values(0), mean.index.get_level_values(1)] = mean.values
+
+    def get_daily(self, group):
+        return slice_group(self.daily, self.groups.get(group))
+
+    def get_account_daily(self, group):
+        return slice_group(self.account_daily, self.groups.get(group))
+
+
+def slice_group(series, code):
+    groups = series.index.get_level_values(0).values
+    start, end = np.searchsorted(groups, code, 'left'), np.searchsorted(groups, code, 'right')
+    return series.iloc[start:end].droplevel(0)
+
+
+def hourly_mean(instances, column, codes, size, daily=True):
+    # Hour of week mean for each code of the hourly sums, or of the rows themselves, in double precision
+    data = pd.DataFrame({'code': codes, 'usagestartdate': instances['usagestartdate'].values,
+                         'hourofweek': instances['hourofweek'].values,
+                         'value': instances[column].values.astype(np.float64)})
+    data = data[data['code'] >= 0]
+    if daily:
+        data = data.groupby(['code', 'usagestartdate', 'hourofweek'])['value'].sum().reset_index()
+    mean = data.groupby(['code', 'hourofweek'])['value'].mean()
+    result = np.full((size, HOURS), np.nan)
+    if len(mean) > 0:
+        result[mean.index.get_level_values(0), mean.index.get_level_values(1)] = mean.values
+    return result
+
+
+def get_ranks(targets):
+    # Position of each row among the earlier rows with the same target
+    return pd.Series(targets, dtype='int64').groupby(targets).cumcount().values
+
+
+def by_rank(targets):
+    # Row numbers split by rank, so that each batch holds at most one row per target
+    ranks = get_ranks(targets)
+    order = np.argsort(ranks, kind='stable')
+    return np.split(order, np.searchsorted(ranks[order], np.arange(1, ranks.max() + 1))) if len(ranks) > 0 else []
+
+
+def kahan_add(total, compensation, count, index, values):
+    present = ~np.isnan(values)
+    y = values - compensation[index]
+    t = total[index] + y
+    compensation[index] = np.where(present, t - total[index] - y, compensation[index])
+    total[index] = np.where(present, t, total[index])
+    count[index] += present
+
+
+def ordered_sum(values, targets, size):
+    # Sums rows of values into targets in row order, skipping NaN.  Returns the sums and the number of values summed.
+    total = np.zeros((size, HOURS))
+    compensation = np.zeros((size, HOURS))
+    count = np.zeros((size, HOURS), dtype=int)
+    for rows in by_rank(targets):
+        kahan_add(total, compensation, count, targets[rows], values[rows])
+    return total, count
+
+
+class Allocation(object):
+    """RI usage of each (region, family, tenancy, operatingsystem) group, as hour of week arrays."""
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.rows = dict((group, row) for row, group in enumerate(groups))
+        self.ri_units = np.zeros(len(groups))
+        self.az_assigned = np.full((len(groups), HOURS), np.nan)
+        self.unused_az_ris = pd.DataFrame(columns=AZ_KEYS + ['min_unused_qty', 'avg_unused_qty', 'max_unused_qty'])
+        self.ri_hourly_usage = pd.DataFrame(columns=REGION_KEYS + ['hourofweek', 'total_ri_units', 'total_instance_units',
+                                                                   'floating_ri_units', 'floating_instance_units',
+                                                                   'unused_ri_units', 'coverage_chance'])
+
+    def get_az_assigned(self, group):
+        # AZ RI usage booked against the group by hour of week, empty without AZ RI usage
+        assigned = self.az_assigned[self.rows[group]]
+        hours = np.flatnonzero(~np.isnan(assigned))
+        return pd.Series(assigned[hours], index=pd.Index(hours, name='hourofweek'), dtype=float)
+
+
+def allocate(instances, ris, groups, pricing, usage=None):
+    """Allocates RIs to instance usage for all groups at once."""
+    if usage is None:
+        usage = InstanceUsage(instances)
+    allocation = Allocation(groups)
+    ri_groups = np.array([allocation.rows.get(key, -1) for key in zip(*(ris[key] for key in REGION_KEYS))], dtype=int)
+
+    # Region usage booked from AZ RIs, as rows of (group, account, hour of week units), in the order it is booked
+    booked_groups, booked_accounts, booked_units = [], [], []
+
+    # Account for In-Account AZ RI usage
+    # In-Account RI usage only needs to be counted against Regional Usage for accuracy
+    az_mask = (ri_groups >= 0) & (ris['scope'].values == 'Availability Zone')
+    az_ris = ris[az_mask]
+    az_ri_groups = ri_groups[az_mask]
+    az_accounts = KeyIndex(instances, AZ_KEYS + ['usageaccountid'])
+    az_ri_rows = np.array([az_accounts.get((az, instancetype) + groups[group][2:] + (accountid,))
+                           for az, instancetype, accountid, group in zip(az_ris['availabilityzone'],
+                           az_ris['instancetype'], az_ris['accountid'], az_ri_groups)], dtype=int)
+    matched = np.flatnonzero(az_ri_rows >= 0)
+    needed = np.unique(az_ri_rows[matched])
+    in_account_usage = hourly_mean(instances, 'instances', az_accounts.remap(needed), len(needed), daily=False)
+
+    # RIs for the same account, AZ and instance type use up the usage in order
+    targets = np.searchsorted(needed, az_ri_rows[matched])
+    quantities = az_ris['quantity'].values[matched].astype(float)
+    assigned = np.zeros((len(needed), HOURS))
+    compensation = np.zeros((len(needed), HOURS))
+    count = np.zeros((len(needed), HOURS), dtype=int)
+    in_account_used = np.empty((len(matched), HOURS))
+    for rows in by_rank(targets):
+        in_account_used[rows] = np.minimum(in_account_usage[targets[rows]] - assigned[targets[rows]],
+                                           quantities[rows, np.newaxis])
+        kahan_add(assigned, compensation, count, targets[rows], in_account_used[rows])
+
+    units = pricing.units_of(az_ris['instancetype'].values[matched])
+    booked_groups.append(az_ri_groups[matched])
+    booked_accounts.extend(az_ris['accountid'].values[matched])
+    booked_units.append(in_account_used * units[:, np.newaxis])
+
+    # Account for Cross-Account AZ RI Usage
+    # To simplify analysis, treat in-account and cross-account identically since we only report unused AZ RIs
+    az_totals = az_ris.groupby([az_ri_groups, 'availabilityzone', 'instancetype'], observed=True)['quantity'].sum()
+    az_index = KeyIndex(instances, AZ_KEYS)
+    az_total_rows = np.array([az_index.get((az, instancetype) + groups[group][2:])
+                              for group, az, instancetype in az_totals.index], dtype=int)
+    found = np.flatnonzero(az_total_rows >= 0)
+    needed = np.unique(az_total_rows[found])
+    total_usage = hourly_mean(instances, 'instances', az_index.remap(needed), len(needed))
+    total_usage = total_usage[np.searchsorted(needed, az_total_rows[found])]
+
+    # No pre-assigned usage since individual RI subscriptions are getting bundled
+    quantities = az_totals.values[found]
+    total_used = np.minimum(total_usage, quantities[:, np.newaxis].astype(float))
+
+    # Add to regional usage for purchase recommendations, in units of the group's last AZ RI as before
+    last_types = dict(zip(az_ri_groups, az_ris['instancetype']))
+    cross_groups = az_totals.index.get_level_values(0).values[found].astype(int)
+    units = pricing.units_of([last_types[group] for group in cross_groups])
+    booked_groups.append(cross_groups)
+    booked_accounts.extend([CROSS_ACCOUNT] * len(found))
+    booked_units.append(total_used * units[:, np.newaxis])
+
+    unused_az_ris = []
+    for row, group in enumerate(cross_groups):
+        unused = quantities[row] - total_used[row][~np.isnan(total_used[row])]
+        if unused.max() > 0:
+            group, availabilityzone, instancetype = az_totals.index[found[row]]
+            region, family, tenancy, operatingsystem = groups[group]
+            unused_az_ris.append({
+                'availabilityzone': availabilityzone,
+                'instancetype': instancetype,
+                'tenancy': tenancy,
+                'operatingsystem': operatingsystem,
+                'min_unused_qty': unused.min(),
+                'avg_unused_qty': unused.mean(),
+                'max_unused_qty': unused.max(),
+            })
+    allocation.unused_az_ris = pd.concat([allocation.unused_az_ris, pd.DataFrame(unused_az_ris)], ignore_index=True)
+
+    booked_groups = np.concatenate(booked_groups).astype(int)
+    booked_units = np.concatenate(booked_units) if len(booked_groups) > 0 else np.empty((0, HOURS))
+    az_assigned, count = ordered_sum(booked_units, booked_groups, len(groups))
+    allocation.az_assigned = np.where(count > 0, az_assigned, np.nan)
+
+    # Account for In-Account Region RI Usage
+    # In-Account Region RI usage only needed to calculate RI Float
+    region_mask = (ri_groups >= 0) & (ris['scope'].values == 'Region')
+    region_ris = ris[region_mask]
+    region_ri_groups = ri_groups[region_mask]
+    region_ri_units = region_ris['units'].values
+    account_ris = region_ris.groupby([region_ri_groups, 'accountid']).indices
+    for group, rows in region_ris.groupby(region_ri_groups).indices.items():
+        allocation.ri_units[group] = region_ri_units[rows].sum()
+
+    # AZ RI usage already booked in each account
+    pairs = {}
+    for key in list(zip(booked_groups, booked_accounts)) + list(account_ris):
+        pairs.setdefault(key, len(pairs))
+    booked_pairs = np.array([pairs[key] for key in zip(booked_groups, booked_accounts)], dtype=int)
+    booked, count = ordered_sum(booked_units, booked_pairs, len(pairs))
+    booked = np.where(count > 0, booked, np.nan)
+    has_booked = (count > 0).any(axis=1)
+
+    region_accounts = KeyIndex(instances, REGION_KEYS + ['usageaccountid'])
+    keys = sorted(account_ris)
+    account_rows = np.array([region_accounts.get(groups[group] + (accountid,)) for group, accountid in keys], dtype=int)
+    found = np.flatnonzero(account_rows >= 0)
+    needed = np.unique(account_rows[found])
+    account_usage = hourly_mean(instances, 'instance_units', region_accounts.remap(needed), len(needed))
+    account_usage = account_usage[np.searchsorted(needed, account_rows[found])]
+
+    account_pairs = np.array([pairs[keys[row]] for row in found], dtype=int)
+    account_ri_units = np.array([region_ri_units[account_ris[keys[row]]].sum() for row in found])
+    remaining = np.where(has_booked[account_pairs, np.newaxis], account_usage - booked[account_pairs], account_usage)
+    used = np.minimum(remaining, account_ri_units[:, np.newaxis])
+
+    # Hours without usage count as 0, while hours only partially covered by AZ RIs are left out of the sum
+    labeled = ~np.isnan(account_usage) | (has_booked[account_pairs, np.newaxis] & ~np.isnan(booked[account_pairs]))
+    used = np.where(labeled, used, 0.0)
+    account_groups = np.array([keys[row][0] for row in found], dtype=int)
+    in_account_usage, count = ordered_sum(used, account_groups, len(groups))
+    evaluated = np.zeros(len(groups), dtype=bool)
+    evaluated[account_groups] = True
+
+    # Account for Cross-Account Region RI Usage
+    total_usage = np.full((len(groups), HOURS), np.nan)
+    for row, group in enumerate(groups):
+        code = usage.groups.get(group)
+        if code >= 0:
+            total_usage[row] = usage.hourly[code]
+        else:
+            # Groups with RIs but without instances have no usage in the hours of the first group
+            total_usage[row] = np.where(np.isnan(usage.hourly[0]), np.nan, 0.0)
+    in_account_usage = np.where(evaluated[:, np.newaxis], in_account_usage, 0.0)
+    ri_units = allocation.ri_units[:, np.newaxis]
+
+    # Floating RIs, instances eligible for float and unused RIs
+    floating_ri_units = ri_units - in_account_usage
+    floating_instance_units = total_usage - in_account_usage
+    unused_ri_units = np.maximum(ri_units - total_usage, 0)
+
+    # % Change a new instance will be covered
+    coverage_chance = floating_ri_units / np.maximum(np.maximum(floating_instance_units, floating_ri_units), 1) * 100
+
+    has_region_ris = np.zeros(len(groups), dtype=bool)
+    has_region_ris[region_ri_groups] = True
+    rows, hours = np.nonzero(has_region_ris[:, np.newaxis] & ~np.isnan(total_usage))
+    ri_hourly_usage = pd.DataFrame([groups[row] for row in rows], columns=REGION_KEYS)
+    ri_hourly_usage['hourofweek'] = hours
+    ri_hourly_usage['total_ri_units'] = allocation.ri_units[rows]
+    ri_hourly_usage['total_instance_units'] = total_usage[rows, hours]
+    ri_hourly_usage['floating_ri_units'] = floating_ri_units[rows, hours]
+    ri_hourly_usage['floating_instance_units'] = floating_instance_units[rows, hours]
+    ri_hourly_usage['unused_ri_units'] = unused_ri_units[rows, hours]
+    ri_hourly_usage['coverage_chance'] = coverage_chance[rows, hours]
+    allocation.ri_hourly_usage = pd.concat([allocation.ri_hourly_usage, ri_hourly_usage], ignore_index=True)
+
+    LOGGER.debug("Allocated RIs for {} groups".format(len(groups)))
+    return allocation
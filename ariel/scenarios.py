@@ -0,0 +1,128 @@
+# Copyright 2019, Oath Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+from ariel import trends, utils, LOGGER
+
+import copy
+import itertools
+import pandas as pd
+import sys
+import yaml
+
+# RI_PURCHASES settings that change the usage evaluated, rather than the purchases made from it
+FIXED_KEYS = ['INCLUDE_ACCOUNTS', 'SKIP_ACCOUNTS', 'EXPIRATION_DAYS', 'FILTER_THRESHOLD']
+
+COST_COLUMNS = ['ri upfront cost', 'ri total cost', 'ri savings', 'ondemand value', 'monthly ri savings']
+
+# Presentation of numeric report columns in CSV reports
+FORMATS = {
+    'SCENARIO_PURCHASES': dict((column, '${:,.2f}') for column in COST_COLUMNS[:4]),
+    'SCENARIO_SUMMARY': dict([(column, '${:,.2f}') for column in COST_COLUMNS] + [('savings rate', '{:.2f}')]),
+}
+
+
+def get_scenarios(config):
+    """Every combination of the RI_PURCHASES values listed in the SCENARIOS section, in configuration order."""
+    grid = config.get('SCENARIOS') or {}
+    if len(grid) == 0:
+        return []
+    for key in grid:
+        if key in FIXED_KEYS:
+            raise ValueError('SCENARIOS can not vary RI_PURCHASES.{}, it changes the usage evaluated'.format(key))
+    values = [value if isinstance(value, list) else [value] for value in grid.values()]
+    return [dict(zip(grid.keys(), combination)) for combination in itertools.product(*values)]
+
+
+def get_name(scenario):
+    return ' '.join('{}={}'.format(key, value) for key, value in scenario.items())
+
+
+def get_config(config, scenario):
+    scenario_config = copy.deepcopy(config)
+    if scenario_config.get('RI_PURCHASES') is None:
+        scenario_config['RI_PURCHASES'] = {}
+    scenario_config['RI_PURCHASES'].update(scenario)
+    return scenario_config
+
+
+def summarize(name, settings, purchases):
+    summary = {'scenario': name}
+    summary.update(settings)
+    summary['purchases'] = len(purchases)
+    summary['quantity'] = purchases['Quantity'].sum()
+    summary['units'] = purchases['units'].sum()
+    for column in COST_COLUMNS[:4]:
+        summary[column] = purchases[column].sum()
+
+    # Savings of 1 and 3 year terms are only comparable per month
+    summary['monthly ri savings'] = (purchases['ri savings'] / purchases['Term'].astype(float)).sum()
+    summary['savings rate'] = summary['ri savings'] / summary['ondemand value'] * 100 if summary['ondemand value'] > 0 else 0.0
+    return summary
+
+
+def evaluate(config, inputs, baseline):
+    """Purchases of every scenario and the baseline configuration, and a summary comparing them."""
+    scenarios = get_scenarios(config)
+    keys = list(scenarios[0].keys()) if len(scenarios) > 0 else []
+    baseline_settings = dict((key, utils.get_config_value(config, 'RI_PURCHASES', key, '')) for key in keys)
+
+    names = ['baseline']
+    purchases = [baseline]
+    summaries = [summarize('baseline', baseline_settings, baseline)]
+    for scenario in scenarios:
+        name = get_name(scenario)
+        LOGGER.info("Evaluating scenario {}".format(name))
+        scenario_config = get_config(config, scenario)
+
+        # Thresholds may be part of the scenario, slopes are not
+        ri_trends = inputs.ri_trends.assign(algorithm=trends.get_algorithms(scenario_config,
+                                                                           inputs.ri_trends['slope'].values))
+        scenario_purchases = inputs.evaluate(scenario_config, ri_trends)
+        names.append(name)
+        purchases.append(scenario_purchases)
+        summaries.append(summarize(name, scenario, scenario_purchases))
+
+    scenario_purchases = pd.concat([frame.assign(scenario=name) for name, frame in zip(names, purchases)],
+                                   ignore_index=True)
+    scenario_purchases = scenario_purchases[['scenario'] + list(baseline.columns)]
+    scenario_summary = pd.DataFrame(summaries)
+
+    return {
+        "SCENARIO_PURCHASES": scenario_purchases,
+        "SCENARIO_SUMMARY": scenario_summary,
+    }
+
+
+def parse_sweep(value):
+    # "RI_TERM=12,36" as ('RI_TERM', [12, 36])
+    key, values = value.split('=', 1)
+    return key, [yaml.safe_load(item) for item in values.split(',')]
+
+
+def cli():
+    import argparse
+    parser = argparse.ArgumentParser(prog='{} {}'.format(*(sys.argv[0], sys.argv[1])))
+    parser.add_argument('--config', required=True, help='Config file to load for Ariel configuration')
+    parser.add_argument('--sweep', type=parse_sweep, action='append', default=[],
+                        help='RI_PURCHASES setting and comma separated values to evaluate, e.g. RI_TERM=12,36.  '
+                             'Replaces the SCENARIOS section of the config.  May be repeated')
+
+    args = parser.parse_args(args=sys.argv[2:])
+    config = utils.load_config(args.config)
+    if len(args.sweep) > 0:
+        config['SCENARIOS'] = dict(args.sweep)
+    if len(get_scenarios(config)) == 0:
+        parser.error('No scenarios configured, add a SCENARIOS section or --sweep')
+
+    from ariel import generate_reports, get_account_instance_summary, get_ec2_pricing, get_reserved_instances
+    instances = get_account_instance_summary.load(config)
+    ris = get_reserved_instances.load(config)
+    pricing = get_ec2_pricing.load(config)
+
+    reports = generate_reports.generate(config, instances, ris, pricing)
+
+    for key in ['SCENARIO_SUMMARY', 'SCENARIO_PURCHASES']:
+        LOGGER.info("Writing {} report to ./output_{}.csv".format(key, key.lower()))
+        utils.format_columns(reports[key], FORMATS[key]).to_csv("output_{}.csv".format(key.lower()), index=False)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,66 @@
+# Copyright 2019, Oath Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+from ariel import ri_allocation, utils, LOGGER
+
+import numpy as np
+import operator
+import pandas as pd
+
+
+def get_usage_matrix(usage):
+    # Hourly instance units as a group x hour matrix, NaN for hours without usage
+    codes = usage.daily.index.get_level_values(0).values
+    hours, columns = np.unique(usage.daily.index.get_level_values('usagestartdate').values, return_inverse=True)
+    matrix = np.full((len(usage.groups), len(hours)), np.nan)
+    matrix[codes, columns] = usage.daily.values
+    return hours, matrix
+
+
+def get_slopes(hours, matrix, threshold):
+    # Least squares slope of each row in units per day, after replacing outliers by the median of the row
+    present = ~np.isnan(matrix)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.abs(matrix - np.nanmean(matrix, axis=1, keepdims=True))
+        median_delta = np.nanmedian(delta, axis=1, keepdims=True)
+        outliers = present & (median_delta > 0) & (delta / median_delta > threshold)
+        signal = np.where(outliers, np.nanmedian(matrix, axis=1, keepdims=True), matrix)
+
+        # Closed form fit on centered values, which keeps precision that raw timestamps would lose
+        days = np.where(present, (hours - hours[0]) / np.timedelta64(1, 'D'), np.nan) if len(hours) > 0 else matrix
+        days = days - np.nanmean(days, axis=1, keepdims=True)
+        signal = signal - np.nanmean(signal, axis=1, keepdims=True)
+    variance = np.nansum(days * days, axis=1)
+    covariance = np.nansum(days * signal, axis=1)
+    slopes = np.divide(covariance, variance, out=np.zeros(len(matrix)), where=variance > 0)
+    return slopes, present.sum(axis=1), outliers.sum(axis=1)
+
+
+def get_algorithms(config, slopes):
+    algorithms = np.full(len(slopes), 'DEFAULT', dtype=object)
+    for algorithm, compare in (('AGGRESSIVE', operator.ge), ('CONSERVATIVE', operator.le)):
+        threshold = utils.get_config_value(config, 'RI_PURCHASES', '{}_THRESHOLD'.format(algorithm), 'NONE')
+        try:
+            algorithms[compare(slopes, float(threshold))] = algorithm
+        except ValueError:
+            pass
+    return algorithms
+
+
+def get_trends(config, usage):
+    """Usage trend and resulting purchase algorithm of every (region, family, tenancy, operatingsystem) group."""
+    threshold = int(utils.get_config_value(config, 'RI_PURCHASES', 'FILTER_THRESHOLD', 3))
+    hours, matrix = get_usage_matrix(usage)
+    slopes, samples, outliers = get_slopes(hours, matrix, threshold)
+
+    if len(usage.groups) > 0:
+        index = pd.MultiIndex.from_tuples(usage.groups.keys, names=ri_allocation.REGION_KEYS)
+    else:
+        index = pd.MultiIndex.from_arrays([[]] * len(ri_allocation.REGION_KEYS), names=ri_allocation.REGION_KEYS)
+    trends = pd.DataFrame({
+        'samples': samples,
+        'outliers': outliers,
+        'slope': slopes,
+        'algorithm': get_algorithms(config, slopes),
+    }, index=index)
+    LOGGER.debug("Estimated trends for {} groups".format(len(trends)))
+    return trends
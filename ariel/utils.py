@@ -1,12 +1,23 @@
 # Copyright 2019, Oath Inc.
 # Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+from ariel import profiling, LOGGER
 from time import sleep
 
 import boto3
+import botocore.config
+import collections
 import csv
+import datetime
+import hashlib
 import io
+import json
+import numpy as np
 import os
+import pandas as pd
+import re
 import tempfile
+import threading
+import time
 import yaml
 
 class AutoVivification(dict):
@@ -26,34 +37,379 @@ class CsvDialect(csv.Dialect):
     quotechar = '"'
     lineterminator = '\n'
 
-def assume_role(session, role):
-    assumedRole = session.client('sts').assume_role(RoleArn=role, RoleSessionName='ariel')
-    access_key = assumedRole['Credentials']['AccessKeyId']
-    access_secret = assumedRole['Credentials']['SecretAccessKey']
-    session_token = assumedRole['Credentials']['SessionToken']
-    return boto3.session.Session(aws_access_key_id = access_key, aws_secret_access_key = access_secret,
-            aws_session_token = session_token)
+class SessionPool(object):
+    """Boto3 sessions and clients shared across loaders and threads, keeping assumed role credentials until near expiry."""
+
+    def __init__(self, session=None, client_config=None):
+        self.base = session
+        self.client_config = CLIENT_CONFIG if client_config is None else client_config
+        self.lock = threading.RLock()
+        self.sessions = {}
+        self.clients = {}
+
+    def session(self, role=None):
+        role = role or None
+        with self.lock:
+            session, expiration = self.sessions.get(role, (None, None))
+            if session is None or (expiration is not None and
+                                   expiration - datetime.datetime.now(datetime.timezone.utc) < CREDENTIAL_REFRESH_MARGIN):
+                if role is None:
+                    session, expiration = self.base or boto3.Session(), None
+                else:
+                    credentials = self.client('sts').assume_role(RoleArn=role, RoleSessionName='ariel')['Credentials']
+                    session = boto3.session.Session(aws_access_key_id=credentials['AccessKeyId'],
+                                                    aws_secret_access_key=credentials['SecretAccessKey'],
+                                                    aws_session_token=credentials['SessionToken'])
+                    expiration = credentials['Expiration']
+                self.sessions[role] = (session, expiration)
+                for key in [key for key in self.clients if key[0] == role]:
+                    del self.clients[key]
+            return session
+
+    def client(self, service, region=None, role=None):
+        role = role or None
+        with self.lock:
+            session = self.session(role)
+            key = (role, service, region)
+            if key not in self.clients:
+                self.clients[key] = session.client(service, region_name=region, config=self.client_config)
+            return self.clients[key]
+
+CLIENT_CONFIG = botocore.config.Config(max_pool_connections=25, retries={'max_attempts': 10, 'mode': 'standard'})
+CREDENTIAL_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+SESSIONS = SessionPool()
+
+class QueryCache(object):
+    """Recent Athena query executions, keyed by database, staging location and normalized SQL, evicted LRU."""
+
+    def __init__(self, size=100):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def key(self, database, staging, query):
+        fingerprint = hashlib.sha256(' '.join(query.split()).rstrip(';').encode('utf-8')).hexdigest()
+        return database, staging, fingerprint
+
+    def get(self, athena, key, max_age):
+        if key not in self.entries:
+            return None
+        query_id, started = self.entries[key]
+        if time.time() - started <= max_age:
+            # Reuse running or succeeded executions whose results are still in the staging location
+            execution = athena.get_query_execution(QueryExecutionId=query_id)['QueryExecution']
+            output = execution.get('ResultConfiguration', {}).get('OutputLocation', '')
+            if execution['Status']['State'] in ('QUEUED', 'RUNNING', 'SUCCEEDED') and output.startswith(key[1]):
+                self.entries.move_to_end(key)
+                return query_id
+        del self.entries[key]
+        return None
+
+    def put(self, key, query_id):
+        self.entries[key] = (query_id, time.time())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+QUERY_CACHE = QueryCache()
+
+class DatasetRegistry(object):
+    """Datasets loaded in this process, keyed by name and the configuration values they were loaded with."""
+
+    def __init__(self):
+        self.entries = {}
+
+    def key(self, config, name, settings, *values):
+        # Settings are (section, key) pairs, or (section, None) for a whole section, plus any derived values
+        selected = []
+        for section_name, key in settings:
+            section = config.get(section_name) or {}
+            selected.append(section if key is None else section.get(key))
+        return name, json.dumps(selected + list(values), sort_keys=True, default=str)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, load):
+        if key in self.entries:
+            LOGGER.info("Reusing loaded {}".format(key[0]))
+        else:
+            self.entries[key] = load()
+        return self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+DATASETS = DatasetRegistry()
+
+def start_athena_query(athena, staging, query, database=None, max_age=0):
+    # With a max_age in seconds, identical queries started within it reuse the earlier execution
+    if max_age > 0:
+        key = QUERY_CACHE.key(database, staging, query)
+        query_id = QUERY_CACHE.get(athena, key, max_age)
+        if query_id is not None:
+            LOGGER.info("Reusing Athena query execution " + query_id)
+            return query_id
 
-def execute_athena_query(athena, staging, query):
     query_id = athena.start_query_execution(QueryString=query, ResultConfiguration={
         'OutputLocation': staging,
         'EncryptionConfiguration': {
             'EncryptionOption': 'SSE_S3'
         }
     })['QueryExecutionId']
+    if max_age > 0:
+        QUERY_CACHE.put(key, query_id)
+    return query_id
 
-    sleep_time = 1
-    while True:
-        status = athena.get_query_execution(QueryExecutionId=query_id)
-        if status['QueryExecution']['Status']['State'] == 'SUCCEEDED':
-            return query_id
-        if status['QueryExecution']['Status']['State'] == 'FAILED':
-            print("ERROR: Query Execution Failure ({0})".format(query))
-            print(status)
-            raise RuntimeError("Query Execution Failure")
-        sleep(sleep_time)
-        if sleep_time < 8:
-            sleep_time *= 2
+class AthenaExecutor(object):
+    """Runs a batch of Athena queries against the CUR database, polling all of them together."""
+
+    def __init__(self, config, session=None):
+        account, role = get_master(config)
+        region   = get_config_value(config, 'ATHENA', 'AWS_REGION',
+                   get_config_value(config, 'DEFAULTS', 'AWS_REGION',
+                                    os.environ.get('AWS_DEFAULT_REGION')))
+        self.database = get_config_value(config, 'ATHENA', 'CUR_DATABASE')
+        self.staging  = get_config_value(config, 'ATHENA', 'STAGING',
+                                         's3://aws-athena-query-results-{0}-{1}/ariel-cur-output/'.format(account, region))
+        proto, empty, self.staging_bucket, self.staging_prefix = self.staging.split('/', 3)
+        self.max_age  = float(get_config_value(config, 'ATHENA', 'RESULT_REUSE_MINUTES', 0)) * 60
+
+        # Share sessions and clients, assuming role if needed
+        self.sessions = SESSIONS if session is None else SessionPool(session)
+
+        # Connect to Athena
+        self.athena = self.sessions.client('athena', region, role)
+        self.s3 = self.sessions.client('s3', None, role)
+        self.query_ids = {}
+        self.states = {}
+        self.validated = False
+
+    def validate(self):
+        # Validate database is usable, once per executor
+        if self.validated:
+            return
+        query = 'SELECT status FROM ' + self.database + '.cost_and_usage_data_status'
+
+        # The status changes as CUR is updated, so it is never reused
+        self.submit(query, max_age=0)
+        status_id = self.execute(query)
+
+        # Row 0 is header
+        status = self.athena.get_query_results(QueryExecutionId=status_id)['ResultSet']['Rows'][1]['Data'][0]['VarCharValue']
+        if status != 'READY':
+            raise Exception('Athena database not in READY status')
+        self.validated = True
+
+    def submit(self, query, max_age=None):
+        # Queries already submitted are not run again
+        if query not in self.query_ids:
+            max_age = self.max_age if max_age is None else max_age
+            self.query_ids[query] = start_athena_query(self.athena, self.staging, query, self.database, max_age)
+            self.states[self.query_ids[query]] = 'QUEUED'
+        return self.query_ids[query]
+
+    def poll(self):
+        running = [query_id for query_id, state in self.states.items() if state in ('QUEUED', 'RUNNING')]
+        for i in range(0, len(running), 50):
+            rsp = self.athena.batch_get_query_execution(QueryExecutionIds=running[i:i + 50])
+            for execution in rsp['QueryExecutions']:
+                self.states[execution['QueryExecutionId']] = execution['Status']['State']
+                if execution['Status']['State'] in ('FAILED', 'CANCELLED'):
+                    LOGGER.error("Query Execution Failure ({0}): {1}".format(execution['Query'], execution['Status']))
+
+    def as_completed(self, queries):
+        # Yields (query, query_id) as each query succeeds.  All submitted queries share one polling backoff.
+        pending = dict((self.submit(query), query) for query in queries)
+        sleep_time = 1
+        while True:
+            for query_id in list(pending):
+                if self.states[query_id] == 'SUCCEEDED':
+                    yield pending.pop(query_id), query_id
+                elif self.states[query_id] in ('FAILED', 'CANCELLED'):
+                    raise RuntimeError("Query Execution Failure")
+            if len(pending) == 0:
+                return
+            self.poll()
+            if any(self.states[query_id] in ('QUEUED', 'RUNNING') for query_id in pending):
+                sleep(sleep_time)
+                if sleep_time < 8:
+                    sleep_time *= 2
+
+    def execute(self, query):
+        with profiling.PROFILER.stage('athena_wait'):
+            for query, query_id in self.as_completed([query]):
+                return query_id
+
+    def read(self, query_id, columns, cache_file=None):
+        # Stream query results from S3 into a typed DataFrame, saving a copy to cache_file if given
+        rsp = self.s3.get_object(Bucket=self.staging_bucket,
+                                 Key='{0}{1}.csv'.format(self.staging_prefix, query_id))
+        tee = open(cache_file + '.tmp', 'wb') if cache_file is not None else None
+        try:
+            with profiling.PROFILER.stage('athena_read') as stage:
+                reader = io.BufferedReader(ChunkReader(rsp['Body'].iter_chunks(STREAM_CHUNK_SIZE), tee), STREAM_CHUNK_SIZE)
+                result = read_csv(reader, columns)
+                stage.rows = len(result)
+        finally:
+            if tee is not None:
+                tee.close()
+        if tee is not None:
+            os.replace(cache_file + '.tmp', cache_file)
+        return result
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+class ChunkReader(io.RawIOBase):
+    """Readable stream over an iterator of byte chunks, optionally copying them to tee as they are read."""
+
+    def __init__(self, chunks, tee=None):
+        self.chunks = iter(chunks)
+        self.tee = tee
+        self.buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buffer) == 0:
+            try:
+                self.buffer = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+            if self.tee is not None:
+                self.tee.write(self.buffer)
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+def read_csv(input, columns):
+    # Columns maps names to dtypes, with 'datetime' for timestamps
+    dtypes = dict((column, dtype) for column, dtype in columns.items() if dtype != 'datetime')
+    dates = [column for column, dtype in columns.items() if dtype == 'datetime']
+    return pd.read_csv(input, dtype=dtypes, parse_dates=dates)
+
+def apply_columns(frame, columns):
+    # Restore column dtypes, e.g. after concatenating frames with different categories
+    for column, dtype in columns.items():
+        if dtype == 'datetime':
+            frame[column] = pd.to_datetime(frame[column])
+        else:
+            frame[column] = frame[column].astype(dtype)
+    return frame
+
+def format_columns(frame, formats):
+    """Copy of frame with its numeric columns as formatted text, e.g. '${:,.2f}', for CSV reports read by people."""
+    frame = frame.copy()
+    for column, fmt in formats.items():
+        if column not in frame.columns:
+            continue
+        if FLOAT_FORMAT.match(fmt) and pd.api.types.is_numeric_dtype(frame[column]) and \
+                not pd.api.types.is_bool_dtype(frame[column]):
+            frame[column] = format_floats(frame[column].to_numpy(dtype=np.float64, na_value=np.nan), fmt)
+        else:
+            frame[column] = frame[column].map(fmt.format)
+    return frame
+
+# Fixed point formats, optionally with a prefix and thousands separators, e.g. '${:,.2f}'
+FLOAT_FORMAT = re.compile(r'^(?P<prefix>[^{}]*)\{:(?P<separators>,?)\.(?P<decimals>\d+)f\}$')
+POWERS_OF_10 = 10 ** np.arange(1, 19, dtype=np.int64)
+
+def format_floats(values, fmt):
+    """Array of fmt.format(value) for a fixed point fmt and float64 values, built as arrays of characters.
+
+    Values that fmt.format may round differently, i.e. within an ulp of a tie, and nan, inf or values too large for
+    exact integers, are formatted by fmt.format itself.
+    """
+    match = FLOAT_FORMAT.match(fmt)
+    prefix, separators, decimals = match.group('prefix'), match.group('separators') == ',', int(match.group('decimals'))
+    scaled = np.abs(values) * 10.0 ** decimals
+    with np.errstate(invalid='ignore'):
+        exact = np.isfinite(scaled) & (scaled < 2.0 ** 52) & \
+            (np.abs(scaled - np.floor(scaled) - 0.5) > scaled * 1e-15 + 1e-300)
+    rounded = np.where(exact, np.floor(scaled + 0.5), 0).astype(np.int64)
+    negative = np.signbit(values)
+
+    # Characters right aligned, from the last decimal to the sign, as code points
+    integer_digits = np.searchsorted(POWERS_OF_10, rounded // 10 ** decimals, side='right') + 1
+    max_digits = integer_digits.max(initial=1)
+    width = decimals + (decimals > 0) + max_digits + (separators * ((max_digits - 1) // 3)) + 1
+    chars = np.zeros((len(values), width), dtype=np.uint32)
+    column = width - 1
+    for digit in range(decimals):
+        chars[:, column] = ord('0') + rounded % 10
+        rounded, column = rounded // 10, column - 1
+    if decimals > 0:
+        chars[:, column] = ord('.')
+        column -= 1
+    for digit in range(max_digits):
+        used = digit < integer_digits
+        if separators and digit > 0 and digit % 3 == 0:
+            chars[:, column] = np.where(used, ord(','), 0)
+            column -= 1
+        chars[:, column] = np.where(used, ord('0') + rounded % 10, 0)
+        rounded, column = rounded // 10, column - 1
+    lengths = decimals + (decimals > 0) + integer_digits + separators * ((integer_digits - 1) // 3) + negative
+    chars[negative, width - lengths[negative]] = ord('-')
+
+    # Left aligned after the prefix, with trailing NULs, which numpy drops from strings
+    offsets = np.arange(width) + (width - lengths)[:, None]
+    aligned = np.where(offsets < width, np.take_along_axis(chars, np.minimum(offsets, width - 1), axis=1), 0)
+    aligned = np.hstack([np.tile(np.array([ord(char) for char in prefix], dtype=np.uint32), (len(values), 1)),
+                         aligned.astype(np.uint32)])
+    text = np.ascontiguousarray(aligned).view('<U{}'.format(aligned.shape[1])).ravel().astype(object)
+    for index in np.flatnonzero(~exact):
+        text[index] = fmt.format(values[index])
+    return text
+
+def round_columns(frame, formats):
+    # Copy of frame with the columns formatted without decimals as integers, e.g. for int database columns
+    frame = frame.copy()
+    for column, fmt in formats.items():
+        if column in frame.columns and fmt.endswith('.0f}'):
+            frame[column] = frame[column].astype(np.float64).round().astype('Int64')
+    return frame
+
+def type_columns(frame, types):
+    """Copy of frame with its columns cast to the types of its database table, e.g. for Parquet reports.
+
+    Types are dtypes, 'datetime', or 'account' for account ids written as 12 digit strings.
+    """
+    frame = frame.copy()
+    for column, dtype in types.items():
+        if column not in frame.columns:
+            continue
+        if dtype == 'account':
+            frame[column] = map_categories(frame[column], '{:012}'.format)
+        elif dtype != 'datetime' and pd.api.types.is_integer_dtype(dtype) and pd.api.types.is_float_dtype(frame[column]):
+            # Units are summed as floats, but stored as integers
+            frame[column] = frame[column].round().astype(dtype)
+        else:
+            apply_columns(frame, {column: dtype})
+            if dtype == 'datetime' and frame[column].dt.tz is not None:
+                # timestamp without time zone, in UTC
+                frame[column] = frame[column].dt.tz_convert(None)
+    return frame
+
+def iter_csv(frame, index=False, batch_rows=10000):
+    # CSV of frame as encoded chunks of batch_rows rows, with the header in the first chunk
+    for start in range(0, max(len(frame), 1), batch_rows):
+        yield frame.iloc[start:start + batch_rows].to_csv(header=start == 0, index=index).encode('utf-8')
+
+def map_categories(series, func):
+    # Applies func once per observed category instead of once per row, keeping the result categorical
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype('category')
+    series = series.cat.remove_unused_categories()
+    categories, inverse = np.unique(np.asarray(series.cat.categories.map(func), dtype=object), return_inverse=True)
+    codes = np.append(inverse, -1)[series.cat.codes.values]
+    return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=series.index, name=series.name)
+
+def memory_usage(frame):
+    return frame.memory_usage(index=True, deep=True).sum() / 1024.0 / 1024.0
 
 def get_master(config):
     account  = get_config_value(config, 'MASTER', 'ACCOUNT_ID', '')
@@ -65,41 +421,101 @@ def get_master(config):
         role = get_config_value(config, 'MASTER', 'ROLE', 'arn:aws:iam::{}:role/ariel-master-usage'.format(account))
     return account, role
 
-def get_read_handle(filename):
+def get_time_range(config):
+    days     = get_config_value(config, 'ATHENA', 'DAYS', 28)
+    offset   = get_config_value(config, 'ATHENA', 'OFFSET', 1)
+
+    # Identify start to end range query
+    today = datetime.datetime.combine(datetime.datetime.today(), datetime.time.min)
+    endtime = today - datetime.timedelta(days=offset)
+    starttime = endtime - datetime.timedelta(days=days)
+    return starttime, endtime
+
+def get_partition_filter(config, starttime, endtime):
+    # Restrict CUR queries to the billing period partitions covering starttime to endtime
+    partitions = get_config_value(config, 'ATHENA', 'PARTITIONS', '')
+    if partitions == '':
+        return ''
+    months = []
+    month = starttime.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while month < endtime:
+        months.append(month)
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+
+    if partitions == 'year/month':
+        year_column  = get_config_value(config, 'ATHENA', 'PARTITION_YEAR', 'year')
+        month_column = get_config_value(config, 'ATHENA', 'PARTITION_MONTH', 'month')
+        return "AND ({}) ".format(' OR '.join("({} = '{}' AND {} = '{}')".format(
+            year_column, month.year, month_column, month.month) for month in months))
+    if partitions == 'billing_period':
+        period_column = get_config_value(config, 'ATHENA', 'PARTITION_BILLING_PERIOD', 'billing_period')
+        period_format = get_config_value(config, 'ATHENA', 'PARTITION_BILLING_PERIOD_FORMAT', '%Y-%m')
+        return "AND {} IN ({}) ".format(period_column, ', '.join(
+            "'{}'".format(month.strftime(period_format)) for month in months))
+    raise ValueError('Unknown ATHENA PARTITIONS: ' + partitions)
+
+def is_cache_fresh(config, cache_file):
+    # If local files exists and is less than a day old, just use it.
+    if not get_config_value(config, 'DEFAULTS', 'CACHING', False):
+        return False
+    try:
+        return os.stat(cache_file).st_mtime > time.time() - 86400
+    except FileNotFoundError:
+        return False
+
+def get_read_handle(filename, mode='r'):
     if filename.startswith('s3:'):
         proto, empty, bucket, key = filename.split('/', 3)
-        rsp = boto3.client('s3').get_object(Bucket=bucket, Key=key)
+        rsp = SESSIONS.client('s3').get_object(Bucket=bucket, Key=key)
         return io.BytesIO(rsp['Body'].read())
     if filename.startswith('http:') or filename.startswith('https:'):
         raise NotImplementedError('HTTP support not yet implemented')
 
     if filename.startswith('file://'):
         proto, empty, filename = filename.split('/', 2)
-    return open(filename, 'r')
+    return open(filename, mode)
+
+
+def list_uri(prefix):
+    # Names of the objects or files directly under a file:// or s3:// prefix
+    if prefix.startswith('s3://'):
+        proto, empty, bucket, key = prefix.split('/', 3)
+        names = []
+        for page in SESSIONS.client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key, Delimiter='/'):
+            names.extend(item['Key'][len(key):] for item in page.get('Contents', []))
+        return names
+    if prefix.startswith('file://'):
+        try:
+            return os.listdir(prefix[7:])
+        except FileNotFoundError:
+            return []
+
+    raise NotImplementedError('Unknown file uri: ' + prefix)
 
 
-def get_temp_write_handle(filename):
+def get_temp_write_handle(filename, mode='w'):
     if filename.startswith('s3://'):
         proto, empty, bucket, key = filename.split('/', 3)
         tmpfd, tmpfile = tempfile.mkstemp(suffix='csv', text=True)
-        return FileUploader(tmpfd, tmpfile, bucket, key)
+        return FileUploader(tmpfd, tmpfile, bucket, key, mode)
     if filename.startswith('file://'):
         dirname, basename = os.path.split(filename[7:])
         tmpfd, tmpfile = tempfile.mkstemp(suffix='csv', dir=dirname, text=True)
-        return FileRenamer(tmpfd, tmpfile, filename[7:])
+        return FileRenamer(tmpfd, tmpfile, filename[7:], mode)
 
 
     raise NotImplementedError('Unknown file uri: ' + filename)
 
 
 class FileRenamer(io.RawIOBase):
-    def __init__(self, fd, tmpfilename, filename):
+    def __init__(self, fd, tmpfilename, filename, mode='w'):
         self.fd = fd
         self.tmpfilename = tmpfilename
         self.filename = filename
+        self.mode = mode
 
     def __enter__(self):
-        self.file = os.fdopen(self.fd, 'w')
+        self.file = os.fdopen(self.fd, self.mode)
         return self.file
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -108,19 +524,20 @@ class FileRenamer(io.RawIOBase):
 
 
 class FileUploader(io.RawIOBase):
-    def __init__(self, fd, tmpfilename, bucket, key):
+    def __init__(self, fd, tmpfilename, bucket, key, mode='w'):
         self.fd = fd
         self.tmpfilename = tmpfilename
         self.bucket = bucket
         self.key = key
+        self.mode = mode
 
     def __enter__(self):
-        self.file = os.fdopen(self.fd, 'w')
+        self.file = os.fdopen(self.fd, self.mode)
         return self.file
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.file.close()
-        boto3.resource('s3').meta.client.upload_file(self.tmpfilename, self.bucket, self.key)
+        SESSIONS.client('s3').upload_file(self.tmpfilename, self.bucket, self.key)
         os.remove(self.tmpfilename)
 
 
@@ -0,0 +1,19 @@
+-- Copyright 2019, Oath Inc.
+-- Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+SET client_min_messages TO warning;
+
+CREATE TABLE reserved_instances_trends
+(
+    region                  character varying(20)       NOT NULL, -- ap-northeast-3 + 6
+    instancetypefamily      character varying(5)        NOT NULL, -- r5ad + 1
+    tenancy                 character varying(9)        NOT NULL, -- [Dedicated, Host, Shared]
+    operatingsystem         character varying(7)        NOT NULL, -- [Linux, RHEL, SUSE, Windows]
+    samples                 int                         NOT NULL,
+    outliers                int                         NOT NULL,
+    slope                   double precision            NOT NULL,
+    algorithm               character varying(12)       NOT NULL, -- [AGGRESSIVE, DEFAULT, CONSERVATIVE]
+	PRIMARY KEY (region, instancetypefamily, tenancy, operatingsystem)
+) WITH ( OIDS=FALSE );
+GRANT ALL ON TABLE reserved_instances_trends TO aurora_dbo;
+GRANT SELECT, UPDATE, INSERT, DELETE, TRUNCATE ON TABLE reserved_instances_trends TO ariel_rw;
+GRANT SELECT ON TABLE reserved_instances_trends TO ariel_ro;
@@ -0,0 +1,16 @@
+-- Copyright 2019, Oath Inc.
+-- Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+SET client_min_messages TO warning;
+
+CREATE TABLE run_profile
+(
+    started                 timestamp                   NOT NULL,
+    stage                   character varying(100)      NOT NULL, -- generate/purchases, group/us-east-1/m5/Shared/Linux
+    wall_seconds            double precision            NOT NULL,
+    cpu_seconds             double precision,
+    peak_rss_mb             double precision,
+    rows                    bigint
+) WITH ( OIDS=FALSE );
+GRANT ALL ON TABLE run_profile TO aurora_dbo;
+GRANT SELECT, UPDATE, INSERT, DELETE, TRUNCATE ON TABLE run_profile TO ariel_rw;
+GRANT SELECT ON TABLE run_profile TO ariel_ro;
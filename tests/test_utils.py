@@ -0,0 +1,38 @@
+# Copyright 2019, Oath Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See LICENSE file for terms.
+from ariel import utils
+
+import numpy as np
+import pandas as pd
+import pytest
+
+VALUES = [0.0, -0.0, 0.004, -0.004, 0.005, 1.005, 2.675, 0.125, -0.125, 999.995, -1234.5, 1234567.891, -98765432.1,
+          123456789012.345, 1e15, 2.0 ** 53, -2.0 ** 60, 1e20, np.nan, np.inf, -np.inf]
+
+
+@pytest.mark.parametrize('fmt', ['${:,.2f}', '${:,.4f}', '{:.2f}', '{:.0f}', '{:,.0f}'])
+def test_format_columns_matches_str_format(fmt):
+    rng = np.random.default_rng(0)
+    values = np.concatenate([VALUES, rng.normal(0, 1e4, 10000), np.round(rng.normal(0, 1e3, 10000), 2) + 0.005,
+                             10.0 ** rng.uniform(-6, 18, 10000) * rng.choice([-1, 1], 10000)])
+    frame = pd.DataFrame({'cost': values, 'name': 'x'})
+    formatted = utils.format_columns(frame, {'cost': fmt, 'missing': fmt})
+    expected = frame['cost'].map(fmt.format)
+    assert formatted['cost'].tolist() == expected.tolist()
+    assert formatted.to_csv().encode('utf-8') == frame.assign(cost=expected).to_csv().encode('utf-8')
+
+
+def test_format_columns_types():
+    frame = pd.DataFrame({'units': np.array([0, 7, 123456], dtype=np.int64),
+                          'amount': np.array([0.5, -1.25, 3.0], dtype=np.float32),
+                          'accountid': [1, 22, 333]})
+    formatted = utils.format_columns(frame, {'units': '{:.0f}', 'amount': '{:.2f}', 'accountid': '{:012}'})
+    assert formatted['units'].tolist() == ['0', '7', '123456']
+    assert formatted['amount'].tolist() == ['0.50', '-1.25', '3.00']
+    assert formatted['accountid'].tolist() == ['000000000001', '000000000022', '000000000333']
+    assert frame['units'].dtype == np.int64
+
+
+def test_format_columns_empty():
+    frame = pd.DataFrame({'cost': np.array([], dtype=np.float64)})
+    assert len(utils.format_columns(frame, {'cost': '${:,.2f}'})) == 0